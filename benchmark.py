@@ -0,0 +1,154 @@
+import argparse
+import json
+import os
+import resource
+import time
+
+# heavy libraries are imported in main() to be part of the measured startup time
+
+
+def percentiles(latencies: list[float]) -> dict:
+    import numpy as np
+
+    if len(latencies) == 0:
+        return {"count": 0}
+
+    values = np.array(latencies) * 1000
+    return {
+        "count": len(latencies),
+        "throughput_per_s": len(latencies) / sum(latencies) if sum(latencies) > 0 else None,
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99))
+    }
+
+
+def timed(fn, values: list) -> (list, list[float]):
+    results = []
+    latencies = []
+
+    for value in values:
+        t = time.perf_counter()
+        results.append(fn(value))
+        latencies.append(time.perf_counter() - t)
+
+    return results, latencies
+
+
+def load_messages(path: str) -> list[str]:
+    messages = []
+
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+
+            # either a plain JSON string or an object like {"content": "..."}
+            record = json.loads(line)
+            messages.append(record if isinstance(record, str) else record["content"])
+
+    return messages
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replays a message corpus through the AutoFAQ hot path.")
+    parser.add_argument("messages", help="JSONL file with one message per line")
+    parser.add_argument("--data", default=".", help="a data.json or a directory with per-topic shards")
+    parser.add_argument("--topic", help="the topic to use, defaults to the first topic of the dataset")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--encoder", default="fp32", help="the encoder backend, e.g. fp32 or int8")
+    parser.add_argument("--precision", default="fp32", help="the precision of the stored embeddings: fp32, fp16 or int8")
+    parser.add_argument("--threshold", type=float, default=0.7,
+                        help="the score from which the full model answers, to measure the lexical filter against")
+    parser.add_argument("--min-recall", type=float, default=0.99,
+                        help="the share of answers the recommended lexical floor has to keep")
+    parser.add_argument("--output", help="writes the report to this file instead of stdout")
+    args = parser.parse_args()
+
+    report = {}
+    messages = load_messages(args.messages)
+
+    t = time.perf_counter()
+    from core import filter
+    from core.classifier import BertClassifier, ModelRegistry
+    from core.files import Data
+    from core.index import IndexSettings
+    from core.lexical import LexicalIndex, evaluate, recommend
+    from core.storage import JsonStorage, MemoryStorage, copy_documents, split
+    report["import_s"] = time.perf_counter() - t
+
+    # the dataset is copied into memory, so the benchmark never modifies it
+    if os.path.isdir(args.data):
+        storage = MemoryStorage()
+        copy_documents(JsonStorage(args.data), storage)
+    else:
+        with open(args.data, 'r') as f:
+            storage = MemoryStorage(split(json.load(f)))
+
+    topic = args.topic
+    if topic is None:
+        topics = storage.topics()
+        if len(topics) == 0:
+            parser.error(f"{args.data} does not contain any topic")
+        topic = topics[0]
+
+    t = time.perf_counter()
+    data = Data(topic, storage=storage)
+    models = ModelRegistry(backend=args.encoder)
+    models.get()
+    report["model_load_s"] = time.perf_counter() - t
+    report["encoder"] = args.encoder
+
+    t = time.perf_counter()
+    classifier = BertClassifier(data, models=models, index_settings=IndexSettings(precision=args.precision))
+    report["classifier_build_s"] = time.perf_counter() - t
+    report["startup_s"] = report["import_s"] + report["model_load_s"] + report["classifier_build_s"]
+
+    report["topic"] = topic
+    report["corpus_size"] = len(classifier.entry_ids)
+    report["precision"] = args.precision
+    report["embedding_bytes"] = classifier.embeds.nbytes()
+    report["messages"] = len(messages)
+
+    cleaned, latencies = timed(data.clean_message, messages)
+    report["clean"] = percentiles(latencies)
+
+    valid, latencies = timed(filter.is_valid, cleaned)
+    report["filter"] = percentiles(latencies)
+    report["valid_messages"] = sum(valid)
+
+    predictions, latencies = timed(classifier.predict, messages)
+    report["predict"] = percentiles(latencies)
+
+    # the lexical filter is measured against the full model on the valid messages
+    lexical = LexicalIndex(classifier.messages)
+    candidates = [i for i in range(len(messages)) if valid[i] and classifier.size() > 0]
+    scores, latencies = timed(lexical.score, [cleaned[i] for i in candidates])
+    answered = [predictions[i][0] is not None and predictions[i][1] >= args.threshold for i in candidates]
+
+    floors = evaluate(scores, answered)
+    report["lexical"] = percentiles(latencies)
+    report["lexical"]["answers"] = sum(answered)
+    report["lexical"]["floors"] = floors
+    report["lexical"]["recommended_floor"] = recommend(floors, args.min_recall)
+
+    batches = [messages[i:i + args.batch_size] for i in range(0, len(messages), args.batch_size)]
+    _, latencies = timed(classifier.rank_messages, batches)
+    report["predict_batched"] = percentiles(latencies)
+    report["predict_batched"]["batch_size"] = args.batch_size
+    report["predict_batched"]["messages_per_s"] = len(messages) / sum(latencies) if sum(latencies) > 0 else None
+
+    # ru_maxrss is reported in kilobytes on linux
+    report["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,15 @@
 import os
+import subprocess
+import sys
+from typing import Optional
 
 import nextcord
 from nextcord.ext import commands
 
-import core.classifier
+import core.faq
 import core.log as log
+import core.metrics
+import core.storage
 from core.faq import Store
 from core.files import Config
 
@@ -14,14 +19,41 @@ intents = nextcord.Intents.default()
 intents.message_content = True
 
 activity = nextcord.Activity(type=config.activity_type(), name=config.activity())
-bot = commands.Bot(intents=intents, activity=activity)
-store = core.faq.setup(Store(bot))
+
+# seconds the bot processes of a sharded bot get to shut down
+SHUTDOWN_TIMEOUT = 30
+
+
+def process_index() -> Optional[int]:
+    # python bot.py --process <n>: runs the shards at index n of "shard_processes"
+    if "--process" in sys.argv:
+        return int(sys.argv[sys.argv.index("--process") + 1])
+    return None
+
+
+def create_bot() -> commands.Bot:
+    shard_count = config.shard_count()
+    if not shard_count:
+        return commands.Bot(intents=intents, activity=activity)
+
+    shard_ids = None
+    processes = config.shard_processes()
+    if processes and process_index() is not None:
+        shard_ids = processes[process_index()]
+
+    log.info(f"Running shards {shard_ids if shard_ids is not None else 'all'} of {shard_count}")
+    return commands.AutoShardedBot(intents=intents, activity=activity, shard_count=shard_count, shard_ids=shard_ids)
+
+
+# created in start(), the launcher of a sharded bot only starts other processes
+bot: Optional[commands.Bot] = None
+store: Optional[Store] = None
 
 
-@bot.event
 async def on_ready():
     print("Bot is ready! - @Pterodactyl")
     log.info('We logged in as', bot.user)
+    store.warm_up()
 
 
 def load_extensions():
@@ -32,14 +64,48 @@ def load_extensions():
 
 
 def start():
+    global bot, store
+
     log.load_logging_handlers()
+    core.storage.setup(core.storage.create(config.storage_engine(), config.storage_path(), config.save_interval()))
+
+    bot = create_bot()
+    bot.event(on_ready)
+    store = core.faq.setup(Store(bot))
     load_extensions()
 
-    log.info("Loading classifiers...")
-    store.load_classifiers()
+    # every process of a sharded bot serves its metrics on its own port
+    port = config.metrics_port()
+    core.metrics.start(port + (process_index() or 0) if port else None)
 
     log.info("Starting bot...")
     bot.run(config.token())
+    store.inference.shutdown()
+    store.shutdown()
+    core.storage.storage.shutdown()
+    core.metrics.shutdown()
+
+
+def launch():
+    # one bot process per entry of "shard_processes", they share the inference worker and the topic indexes
+    processes = [subprocess.Popen([sys.executable, sys.argv[0], "--process", str(i)])
+                 for i in range(len(config.shard_processes()))]
+
+    try:
+        for process in processes:
+            process.wait()
+    except KeyboardInterrupt:
+        # the children got the interrupt as well and flush their pending saves while shutting down
+        for process in processes:
+            try:
+                process.wait(SHUTDOWN_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                log.warning(f"Bot process {process.pid} did not shut down in time, terminating it.")
+                process.terminate()
+                process.wait()
 
 
-start()
+if config.shard_count() and config.shard_processes() and process_index() is None:
+    launch()
+else:
+    start()
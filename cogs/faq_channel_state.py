@@ -2,7 +2,7 @@ import nextcord
 from nextcord import SlashOption
 from nextcord.ext.commands import Cog, Bot
 
-import core.classifier
+import core.faq
 import core.log as log
 from core.faq import Store
 
@@ -47,7 +47,7 @@ class FaqChannel(Cog):
 
         topic = topic.lower().strip()
 
-        no_data = self.store.classifiers.get(topic) is None
+        no_data = topic not in self.store.classifiers
 
         if self.store.config.enable_channel(channel, topic):
             log.info("AutoFAQ enabled for channel", f"'{channel.name}'",
@@ -2,7 +2,7 @@ import nextcord
 from nextcord import SlashOption, Embed
 from nextcord.ext.commands import Cog, Bot
 
-import core.classifier
+import core.faq
 import core.log as log
 from core.faq import Store, AutoFaq
 from core.files import LinkedFaqEntry
@@ -50,8 +50,8 @@ async def faq_edit_callback(modal: FaqEditModal, interaction: nextcord.Interacti
                  f"by {interaction.user.name}#{interaction.user.discriminator}.",
                  response.replace('*', ''))
 
+        # the short and the answer are not part of the embeddings, so there is nothing to refit
         modal.faq.data.save()
-        modal.faq.refit()
 
 
 async def check_parameters(interaction: nextcord.Interaction, topic: str, abbreviation: str, store: Store) \
@@ -59,6 +59,11 @@ async def check_parameters(interaction: nextcord.Interaction, topic: str, abbrev
     abbreviation = abbreviation.lower().strip()
     classifier: AutoFaq = store.classifiers.get(topic)
 
+    if not classifier and store.classifiers.loading(topic):
+        await interaction.send(f"The topic *{topic}* is still loading. Please try again in a moment. ⏳",
+                               ephemeral=True)
+        return None, None, None
+
     if not classifier:
         await interaction.send(f"This topic does not exist. You have to enable a topic by using `/faq_enable`.",
                                ephemeral=True)
@@ -118,6 +123,11 @@ class FaqConfig(Cog):
 
         classifier: AutoFaq = self.store.classifiers.get(topic)
 
+        if not classifier and self.store.classifiers.loading(topic):
+            await interaction.send(f"The topic *{topic}* is still loading. Please try again in a moment. ⏳",
+                                   ephemeral=True)
+            return
+
         if not classifier:
             await interaction.send(f"This topic does not exist. You have to enable a topic by using `/faq_enable`. 🤔",
                                    ephemeral=True)
@@ -174,7 +184,7 @@ class FaqConfig(Cog):
         abbreviation, classifier, entry = await check_parameters(interaction, topic, abbreviation, self.store)
 
         if abbreviation and classifier and entry:
-            classifier.data.delete_faq_entry(entry)
+            await classifier.delete_entry(entry)
 
             log.info(f"The FAQ entry '{entry.short()}' has been deleted",
                      f"by {interaction.user.name}#{interaction.user.discriminator}. It's answer was: '{entry.answer()}'")
@@ -192,8 +202,6 @@ class FaqConfig(Cog):
             )
             await interaction.send(embed=embed, view=FaqDeleteUndoView(classifier, entry), ephemeral=True)
 
-            classifier.refit()
-
 
 def setup(bot: Bot):
     bot.add_cog(FaqConfig(bot, core.faq.store))
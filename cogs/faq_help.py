@@ -2,7 +2,7 @@ import nextcord
 from nextcord import Embed
 from nextcord.ext.commands import Cog, Bot
 
-import core.classifier
+import core.faq
 from core.faq import Store
 from core.magic import COLOR_PRIMARY
 
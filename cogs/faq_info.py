@@ -5,7 +5,7 @@ import nextcord
 from nextcord import SlashOption, Embed
 from nextcord.ext.commands import Cog, Bot
 
-import core.classifier
+import core.faq
 from core.faq import Store, AutoFaq
 from core.files import LinkedFaqEntry
 from core.magic import COLOR_PRIMARY, COLOR_SUCCESS
@@ -35,6 +35,11 @@ class FaqInfo(Cog):
                   )):
         classifier: AutoFaq = self.store.classifiers.get(topic)
 
+        if not classifier and self.store.classifiers.loading(topic):
+            await interaction.send(f"The topic *{topic}* is still loading. Please try again in a moment. ⏳",
+                                   ephemeral=True)
+            return
+
         if not classifier:
             await interaction.send(f"This topic does not exist. You have to enable a topic by using `/faq_enable`.",
                                    ephemeral=True)
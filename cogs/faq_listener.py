@@ -1,10 +1,14 @@
+import heapq
 import re
 import time
+from collections import deque
+from typing import Optional
 
 import nextcord
 from nextcord.ext import commands
 
-import core.classifier
+import core.faq
+from core import metrics
 from core.faq import Store, AutoFaq
 
 
@@ -20,39 +24,107 @@ def has_permission(user: nextcord.Member) -> bool:
 
 
 class ResponseLimiter:
-    def __init__(self, limit_in_sec: int = 10):
-        self.replies = dict()
+    def __init__(self, limit_in_sec: float = 10):
+        self.replies: dict[int, float] = dict()
+        # (time of the reply, user id) in the order of the replies, which is also the order in which they expire
+        self.expiry: deque[(float, int)] = deque()
         self.limit_in_sec = limit_in_sec
 
-    def __remove_unnecessary__(self):
-        t = time.time()
+    def __remove_unnecessary__(self, t: float):
+        while len(self.expiry) > 0 and t - self.expiry[0][0] >= self.limit_in_sec:
+            last, key = self.expiry.popleft()
 
-        discarding = []
-        for key in self.replies.keys():
-            last = self.replies[key]
-            if t - last >= self.limit_in_sec:
-                discarding.append(key)
-
-        for key in discarding:
-            self.replies.pop(key)
+            # the user got another reply later on, which has its own entry
+            if self.replies.get(key) == last:
+                self.replies.pop(key)
 
     def check(self, user_id: int) -> bool:
-        self.__remove_unnecessary__()
+        t = time.monotonic()
+        self.__remove_unnecessary__(t)
 
         last = self.replies.get(user_id)
-        t = time.time()
-
         return last is None or t - last >= self.limit_in_sec
 
     def add(self, user_id: int) -> None:
-        self.replies[user_id] = time.time()
+        t = time.monotonic()
+        self.replies[user_id] = t
+        self.expiry.append((t, user_id))
+
+
+class TokenBuckets:
+    # allows bursts of replies per key (a channel or a guild) and refills them at a steady rate
+    def __init__(self, per_minute: Optional[float], burst: int):
+        self.rate = per_minute / 60 if per_minute else None
+        self.burst = max(burst, 1)
+        # key -> (tokens, time of the last update)
+        self.buckets: dict[int, (float, float)] = dict()
+        # heap of (time at which the bucket is full again, key), full buckets are dropped
+        self.expiry: list[(float, int)] = []
+
+    def __refill__(self, key: int, t: float) -> float:
+        tokens, last = self.buckets.get(key, (self.burst, t))
+        return min(self.burst, tokens + (t - last) * self.rate)
+
+    def __remove_unnecessary__(self, t: float):
+        while len(self.expiry) > 0 and self.expiry[0][0] <= t:
+            _, key = heapq.heappop(self.expiry)
+
+            if key in self.buckets and self.__refill__(key, t) >= self.burst:
+                self.buckets.pop(key)
+
+    def check(self, key: int) -> bool:
+        if self.rate is None:
+            return True
+
+        t = time.monotonic()
+        self.__remove_unnecessary__(t)
+        return self.__refill__(key, t) >= 1
+
+    def take(self, key: int) -> None:
+        # only called after a successful check()
+        if self.rate is None:
+            return
+
+        t = time.monotonic()
+        tokens = self.__refill__(key, t) - 1
+        self.buckets[key] = tokens, t
+        heapq.heappush(self.expiry, (t + (self.burst - tokens) / self.rate, key))
 
 
 class FaqListener(commands.Cog):
     def __init__(self, bot: commands.Bot, store: Store):
         self.bot = bot
         self.store = store
-        self.limiter = ResponseLimiter()
+        config = store.config
+        self.limiter = ResponseLimiter(config.user_reply_interval())
+        # a flood of questions must not make the bot spam replies or run into the rate limits of discord
+        self.channel_limiter = TokenBuckets(config.channel_replies_per_minute(), config.channel_reply_burst())
+        self.guild_limiter = TokenBuckets(config.guild_replies_per_minute(), config.guild_reply_burst())
+
+    def allowed(self, topic: str, user_id: int, channel: nextcord.TextChannel) -> bool:
+        scope = None
+        if not self.limiter.check(user_id):
+            scope = "user"
+        elif not self.channel_limiter.check(channel.id):
+            scope = "channel"
+        elif not self.guild_limiter.check(channel.guild.id):
+            scope = "guild"
+
+        if scope is not None:
+            metrics.RATE_LIMITED.inc(topic, scope)
+            return False
+        return True
+
+    def reserve(self, topic: str, user_id: int, channel: nextcord.TextChannel) -> bool:
+        # called right before an answer is sent, without yielding to the event loop. Checking only before the
+        # prediction would let every message predicted at the same time pass.
+        if not self.allowed(topic, user_id, channel):
+            return False
+
+        self.limiter.add(user_id)
+        self.channel_limiter.take(channel.id)
+        self.guild_limiter.take(channel.guild.id)
+        return True
 
     @commands.Cog.listener()
     async def on_thread_join(self, thread: nextcord.Thread):
@@ -62,7 +134,10 @@ class FaqListener(commands.Cog):
         if not topic:
             return
 
-        faq: AutoFaq = self.store.classifiers[topic]
+        faq: AutoFaq = self.store.classifiers.get(topic)
+        if not faq:
+            # still loading
+            return
 
         message = None
         async for m in thread.history(limit=2, oldest_first=True):
@@ -76,11 +151,11 @@ class FaqListener(commands.Cog):
         if message.author.bot or has_permission(author):
             return
 
-        if not self.limiter.check(author.id):
+        # skips the prediction early, the budgets are only reserved right before answering
+        if not self.allowed(topic, author.id, parent):
             return
 
-        if await faq.check_message(thread.name, message):
-            self.limiter.add(author.id)
+        await faq.check_message(thread.name, message, lambda: self.reserve(topic, author.id, parent))
 
     @commands.Cog.listener()
     async def on_message(self, message: nextcord.Message):
@@ -96,10 +171,14 @@ class FaqListener(commands.Cog):
         if not topic:
             return
 
-        if not self.limiter.check(message.author.id):
+        # staff members are not limited, their replies are explicitly asked for
+        if not has_permission(message.author) and not self.allowed(topic, message.author.id, channel):
             return
 
-        faq: AutoFaq = self.store.classifiers[topic]
+        faq: AutoFaq = self.store.classifiers.get(topic)
+        if not faq:
+            # messages are skipped until the topic is loaded
+            return
 
         if has_permission(message.author):
             if self.bot.user in message.mentions:
@@ -118,8 +197,8 @@ class FaqListener(commands.Cog):
                 # just ignore message from staff members
                 pass
         else:
-            if await faq.check_message(message.content, message):
-                self.limiter.add(message.author.id)
+            await faq.check_message(message.content, message,
+                                    lambda: self.reserve(topic, message.author.id, channel))
 
     async def process_add(self, topic: str, message: nextcord, short: str):
         ref: nextcord.MessageReference = message.reference
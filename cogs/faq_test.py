@@ -2,7 +2,7 @@ import nextcord
 from nextcord import SlashOption, Embed
 from nextcord.ext.commands import Cog, Bot
 
-import core.classifier
+import core.faq
 from core.faq import Store, AutoFaq
 from core.files import LinkedFaqEntry
 from core.magic import COLOR_PRIMARY, COLOR_FAIL
@@ -40,12 +40,17 @@ class FaqTest(Cog):
         topic = topic.lower().strip()
         faq: AutoFaq = self.store.classifiers.get(topic)
 
+        if not faq and self.store.classifiers.loading(topic):
+            # the prediction is sent as soon as the topic is loaded
+            await interaction.response.defer(ephemeral=True)
+            faq = await self.store.classifiers.wait(topic)
+
         if not faq:
             await interaction.send(f"This topic does not exist. You have to enable a topic by using `/faq_enable`.",
                                    ephemeral=True)
             return
 
-        class_id, p = faq.classifier.predict(message)
+        class_id, p = await faq.predict(message)
 
         if class_id is not None:
             t = faq.calculate_threshold(class_id)
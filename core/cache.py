@@ -0,0 +1,181 @@
+import asyncio
+import fcntl
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable, Optional
+
+import numpy as np
+
+from core import metrics
+
+
+def message_hash(message: str) -> str:
+    return hashlib.sha1(message.encode("utf-8")).hexdigest()
+
+
+# The embeddings of one model are appended to a raw float32 matrix which is memory-mapped for reading, so several
+# processes can share the same pages. An append-only log maps the hash of every cached message to its row. Writers of
+# all processes take an exclusive file lock, readers only pick up complete rows and log lines.
+class EmbeddingCache:
+    def __init__(self, model_name: str, dimension: int, directory: str = "embeddings"):
+        self.dimension = dimension
+        self.directory = directory
+
+        name = re.sub(r"[^a-zA-Z0-9_.-]", "_", model_name)
+        self.log_path = os.path.join(directory, f"{name}.log")
+        self.lock_path = os.path.join(directory, f"{name}.lock")
+        self.matrix_path = os.path.join(directory, f"{name}.f32")
+
+        self.index: dict[str, int] = {}
+        self.log_offset = 0
+        self.matrix: Optional[np.memmap] = None
+        # background refits and incremental appends may encode at the same time
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self) -> None:
+        self.index = {}
+        self.log_offset = 0
+        self.__read_log__()
+        self.__map__()
+
+    def __read_log__(self) -> None:
+        if not os.path.exists(self.log_path):
+            return
+
+        with open(self.log_path, 'rb') as f:
+            f.seek(self.log_offset)
+            chunk = f.read()
+
+        # the last line might still be written by another process
+        end = chunk.rfind(b"\n") + 1
+        for line in chunk[:end].decode("utf-8").splitlines():
+            key, row = line.split(" ")
+            self.index[key] = int(row)
+
+        self.log_offset += end
+
+    def __file_rows__(self) -> int:
+        if not os.path.exists(self.matrix_path):
+            return 0
+        return os.path.getsize(self.matrix_path) // (self.dimension * 4)
+
+    def __map__(self) -> None:
+        rows = self.__file_rows__()
+
+        if rows == 0:
+            self.matrix = None
+        else:
+            self.matrix = np.memmap(self.matrix_path, dtype=np.float32, mode='r', shape=(rows, self.dimension))
+
+    def __refresh__(self) -> None:
+        # another process might have appended embeddings in the meantime
+        if os.path.exists(self.log_path) and os.path.getsize(self.log_path) < self.log_offset:
+            # the cache has been deleted and started over
+            self.load()
+            return
+
+        self.__read_log__()
+        if self.__file_rows__() != self.rows():
+            self.__map__()
+
+    def rows(self) -> int:
+        return 0 if self.matrix is None else self.matrix.shape[0]
+
+    def encode(self, messages: list[str], encoder: Callable[[list[str]], np.ndarray]) -> np.ndarray:
+        embeds = np.empty((len(messages), self.dimension), dtype=np.float32)
+        hashes = [message_hash(m) for m in messages]
+
+        missing = []
+        with self.lock:
+            self.__refresh__()
+
+            for i in range(len(messages)):
+                row = self.index.get(hashes[i])
+                if row is not None and row < self.rows():
+                    embeds[i] = self.matrix[row]
+                else:
+                    missing.append(i)
+
+        if len(missing) == 0:
+            return embeds
+
+        # the lock is not held while encoding, so a message might be stored twice which is harmless
+        encoded = encoder([messages[i] for i in missing])
+        embeds[missing] = encoded
+        with self.lock:
+            self.__store__([hashes[i] for i in missing], encoded)
+
+        return embeds
+
+    def __store__(self, hashes: list[str], embeds: np.ndarray) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        row_size = self.dimension * 4
+
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.matrix_path, 'ab') as f:
+                    # the file size is only read under the lock, a partial row of an interrupted write is cut off
+                    first_row = os.fstat(f.fileno()).st_size // row_size
+                    f.truncate(first_row * row_size)
+                    f.write(np.ascontiguousarray(embeds, dtype=np.float32).tobytes())
+
+                # the rows are complete before the log points to them
+                lines = "".join(f"{hashes[i]} {first_row + i}\n" for i in range(len(hashes)))
+                with open(self.log_path, 'ab') as f:
+                    f.write(lines.encode("utf-8"))
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        self.__refresh__()
+
+
+# LRU of recent predictions which is cleared as soon as the classifier generation changes. Identical requests that
+# arrive while the first one is still computing wait for its result instead of computing it again.
+class PredictionCache:
+    def __init__(self, size: int = 1024, topic: str = ""):
+        self.size = size
+        self.topic = topic
+        self.entries: OrderedDict = OrderedDict()
+        self.in_flight: dict[tuple, asyncio.Future] = {}
+        self.generation: Optional[int] = None
+
+    async def get(self, generation: int, key: Hashable, compute: Callable[[], Awaitable]):
+        if generation != self.generation:
+            self.entries.clear()
+            self.generation = generation
+
+        if key in self.entries:
+            metrics.PREDICTION_CACHE.inc(self.topic, "hit")
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        flight = self.in_flight.get((generation, key))
+        if flight is not None:
+            metrics.PREDICTION_CACHE.inc(self.topic, "shared")
+            return await asyncio.shield(flight)
+
+        metrics.PREDICTION_CACHE.inc(self.topic, "miss")
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[(generation, key)] = future
+
+        try:
+            result = await compute()
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # waiters re-raise it, nobody else has to retrieve it
+            raise
+        finally:
+            self.in_flight.pop((generation, key), None)
+
+        if generation == self.generation and self.size > 0:
+            self.entries[key] = result
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+        future.set_result(result)
+        return result
@@ -1,47 +1,286 @@
+import hashlib
+import itertools
+import os
+import threading
 from typing import Optional
+from urllib.parse import quote
 
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
+import numpy as np
 
-from core import filter
+import core.log as log
+from core import encoder, filter, metrics
+from core.cache import EmbeddingCache, message_hash
 from core.files import Data
+from core.index import Embeddings, ExactIndex, IndexSettings, build_index
+from core.inference import InferenceEngine
+from core.lexical import LexicalIndex
+
+DEFAULT_MODEL = 'all-MiniLM-L6-v2'
+
+# every change of a classifier's corpus gets a new generation, shared by all classifiers so refits never collide
+GENERATIONS = itertools.count()
+
+
+def normalize(embeds: np.ndarray) -> np.ndarray:
+    embeds = np.asarray(embeds, dtype=np.float32)
+    norms = np.linalg.norm(embeds, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return np.ascontiguousarray(embeds / norms)
+
+
+class Ranking:
+    def __init__(self, top: list[tuple[int, float]], entries: dict[int, float]):
+        # best k (entry id, score) pairs in descending order, entry id -1 is nonsense
+        self.top = top
+        # best score of every entry in the corpus
+        self.entries = entries
+
+    def best(self) -> (Optional[int], Optional[float]):
+        if len(self.top) == 0:
+            return None, None
+
+        class_idx, p = self.top[0]
+        if class_idx == -1:
+            # nonsense
+            return None, p
+
+        return class_idx, p
+
+
+class ModelRegistry:
+    def __init__(self, cache_directory: Optional[str] = None, backend: str = encoder.DEFAULT_BACKEND):
+        self.models: dict[str, encoder.Encoder] = {}
+        self.caches: dict[str, EmbeddingCache] = {}
+        self.cache_directory = cache_directory
+        self.backend = backend
+
+    def get(self, name: str = DEFAULT_MODEL) -> encoder.Encoder:
+        model = self.models.get(name)
+
+        if model is None:
+            model = encoder.create(self.backend, encoder.load_model(name))
+            log.info(f"Warmed up the {self.backend} encoder of {name} in {round(model.warm_up(), 2)}s.")
+            self.models[name] = model
+
+        return model
+
+    def key(self, name: str = DEFAULT_MODEL) -> str:
+        # embeddings of different backends differ slightly, so they are cached separately
+        return name if self.backend == encoder.DEFAULT_BACKEND else f"{name}.{self.backend}"
+
+    def cache(self, name: str = DEFAULT_MODEL) -> Optional[EmbeddingCache]:
+        if not self.cache_directory:
+            return None
+
+        cache = self.caches.get(name)
+
+        if cache is None:
+            cache = EmbeddingCache(self.key(name), self.get(name).dimension(), self.cache_directory)
+            self.caches[name] = cache
+
+        return cache
 
 
 class BertClassifier:
-    def __init__(self, data: Data, test_split: Optional[float] = None, random_state: int = None):
+    def __init__(self, data: Data, test_split: Optional[float] = None, random_state: int = None,
+                 models: Optional[ModelRegistry] = None, inference: Optional[InferenceEngine] = None,
+                 index_settings: Optional[IndexSettings] = None):
         self.test_split = test_split
         self.random_state = random_state
         self.data = data
         self.score: Optional[float] = None
+        self.inference = inference
+        self.index_settings = index_settings if index_settings is not None else IndexSettings()
+        self.lock = threading.Lock()
+        self.generation = next(GENERATIONS)
+
+        if models is None:
+            models = ModelRegistry()
 
         self.entry_ids, self.messages = self.messages()
-        self.classifier: SentenceTransformer = SentenceTransformer('all-MiniLM-L6-v2')
-        self.embeds = self.classifier.encode(self.messages)
+        self.classifier: encoder.Encoder = models.get()
+        self.cache: Optional[EmbeddingCache] = models.cache()
+        self.entry_ids = np.asarray(self.entry_ids, dtype=np.int32)
+        self.embeds = self.__embed_corpus__(models)
+        self.index = build_index(self.embeds, self.index_settings)
+        self.lexical: Optional[LexicalIndex] = LexicalIndex(self.messages) \
+            if self.index_settings.lexical_floor is not None else None
+
+    def __embed_corpus__(self, models: ModelRegistry) -> Embeddings:
+        precision = self.index_settings.precision
+        directory = self.index_settings.shared_directory
+
+        if not directory:
+            return Embeddings.compress(normalize(self.encode_corpus(self.messages)), precision)
+
+        # processes with the same corpus map the same file, appends later on are private to a process until the
+        # next refit
+        key = hashlib.sha1("\n".join([models.key(), precision] + [message_hash(m) for m in self.messages])
+                           .encode("utf-8")).hexdigest()
+        directory = os.path.join(directory, quote(self.data.topic, safe=""))
+        path = os.path.join(directory, key)
+
+        embeds = Embeddings.load(path, precision)
+        if embeds is not None:
+            return embeds
+
+        embeds = Embeddings.compress(normalize(self.encode_corpus(self.messages)), precision).save(path)
+
+        # older corpora of the topic stay mapped by the processes which still use them
+        for file_name in os.listdir(directory):
+            if not file_name.startswith(f"{key}.") and not file_name.endswith(".tmp"):
+                try:
+                    os.remove(os.path.join(directory, file_name))
+                except FileNotFoundError:
+                    pass
+
+        return embeds
+
+    def size(self) -> int:
+        return len(self.entry_ids)
+
+    def encode(self, messages: list[str]) -> np.ndarray:
+        return self.classifier.encode(messages)
+
+    def encode_corpus(self, messages: list[str]) -> np.ndarray:
+        if self.cache is None or len(messages) == 0:
+            return self.encode(messages)
+        return self.cache.encode(messages, self.encode)
+
+    def append(self, entry_id: int, messages: list[str]) -> None:
+        if len(messages) == 0:
+            return
+
+        embeds = normalize(self.encode_corpus(messages))
+
+        embeds = self.embeds.appended(embeds)
+        index = build_index(embeds, self.index_settings, self.index)
+
+        with self.lock:
+            self.embeds = embeds
+            self.index = index
+            self.entry_ids = np.concatenate([self.entry_ids, np.full(len(messages), entry_id, dtype=np.int32)])
+            self.messages = self.messages + messages
+            self.generation = next(GENERATIONS)
+
+        if self.lexical is not None:
+            self.lexical.add(messages)
+
+    def remove(self, entry_id: int) -> None:
+        # drops every message of the entry and shifts the ids of all following entries like Data does
+        keep = np.flatnonzero(self.entry_ids != entry_id)
+        embeds = self.embeds.take(keep)
+
+        if isinstance(self.index, ExactIndex) or len(embeds) < self.index_settings.min_size:
+            index = build_index(embeds, self.index_settings)
+        else:
+            index = self.index.subset(embeds, keep)
+
+        if self.lexical is not None:
+            self.lexical.remove([m for m, e in zip(self.messages, self.entry_ids) if e == entry_id])
+
+        with self.lock:
+            self.embeds = embeds
+            self.index = index
+            self.messages = [self.messages[i] for i in keep]
+            entry_ids = self.entry_ids[keep]
+            self.entry_ids = np.where(entry_ids > entry_id, entry_ids - 1, entry_ids)
+            self.generation = next(GENERATIONS)
+
+    def relabel(self, old_id: int, new_id: int) -> None:
+        with self.lock:
+            self.entry_ids = np.where(self.entry_ids == old_id, new_id, self.entry_ids).astype(np.int32)
+            self.generation = next(GENERATIONS)
+
+    async def predict_async(self, message: str) -> (Optional[int], int):
+        if self.inference is None:
+            return self.predict(message)
+        return await self.inference.predict(self, message)
+
+    def prepare(self, message: str) -> Optional[str]:
+        with metrics.CLEAN.time():
+            message = self.data.clean_message(message)
+
+        with metrics.FILTER.time():
+            valid = filter.is_valid(message)
+
+        if not valid or len(self.entry_ids) == 0 or not self.plausible(message):
+            return None
+
+        return message
+
+    def plausible(self, message: str) -> bool:
+        if self.lexical is None or self.lexical.plausible(message, self.index_settings.lexical_floor):
+            return True
+
+        metrics.LEXICAL_SKIPPED.inc(self.data.topic)
+        return False
 
     def predict(self, message: str) -> (Optional[int], int):
-        message = self.data.clean_message(message)
+        message = self.prepare(message)
 
-        if not filter.is_valid(message):
+        if message is None:
             return None, None
 
-        if len(self.messages) == 0:
-            return None, None
+        with metrics.ENCODE.time():
+            embed = self.encode([message])[0]
 
-        embed = self.classifier.encode([message])[0]
+        with metrics.SIMILARITY.time():
+            return self.classify(embed)
 
-        p = cosine_similarity(
-            [embed],
-            self.embeds
-        )[0]
+    def classify(self, embed: np.ndarray) -> (Optional[int], Optional[float]):
+        return self.rank(embed, 1, entries=False)[0].best()
 
-        max_idx = p.argmax()
-        class_idx = self.entry_ids[max_idx]
+    def rank_messages(self, messages: list[str], k: int = 5) -> list[Optional[Ranking]]:
+        prepared = [self.prepare(m) for m in messages]
+        valid = [i for i in range(len(prepared)) if prepared[i] is not None]
 
-        if class_idx == -1:
-            # nonsense
-            return None, p.max()
+        rankings = [None] * len(messages)
+        if len(valid) == 0:
+            return rankings
+
+        embeds = self.encode([prepared[i] for i in valid])
+        for i, ranking in zip(valid, self.rank(embeds, k)):
+            rankings[i] = ranking
+
+        return rankings
+
+    def rank(self, embeds: np.ndarray, k: int = 5, entries: bool = True) -> list[Ranking]:
+        # predictions run on inference threads, so take a consistent view of the corpus
+        with self.lock:
+            index, entry_ids = self.index, self.entry_ids
+
+        queries = normalize(np.atleast_2d(embeds))
+
+        if len(entry_ids) == 0:
+            return [Ranking([], {}) for _ in range(len(queries))]
+
+        rankings = []
+        for rows, scores in index.scores(queries):
+            ids = entry_ids if rows is None else entry_ids[rows]
+
+            if len(scores) == 0:
+                rankings.append(Ranking([], {}))
+                continue
+
+            # argpartition finds the k best candidates in linear time, only those are sorted
+            n = min(k, len(scores))
+            top = np.argpartition(-scores, n - 1)[:n]
+            top = top[np.argsort(-scores[top])]
+
+            rankings.append(Ranking(
+                [(int(ids[j]), float(scores[j])) for j in top],
+                self.__best_per_entry__(scores, ids) if entries else {}
+            ))
+
+        return rankings
 
-        return class_idx, p.max()
+    @staticmethod
+    def __best_per_entry__(scores: np.ndarray, entry_ids: np.ndarray) -> dict[int, float]:
+        # ids are shifted by one to make room for nonsense (-1)
+        best = np.full(entry_ids.max() + 2, -np.inf, dtype=np.float32)
+        np.maximum.at(best, entry_ids + 1, scores)
+        return {entry_id - 1: float(p) for entry_id, p in enumerate(best) if p > -np.inf}
 
     def messages(self) -> (dict, list[str]):
         entry_ids = []
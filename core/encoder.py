@@ -0,0 +1,153 @@
+import time
+from typing import Optional
+
+import numpy as np
+
+DEFAULT_BACKEND = "fp32"
+
+# a few short and long messages, so the first real message does not pay for lazy initialization
+WARM_UP_MESSAGES = [
+    "hi",
+    "how do i install the plugin?",
+    "the server crashes on startup after i updated to the latest version, the log says that a class could not be found"
+]
+
+
+# torch and sentence_transformers take seconds to import, so they are only imported once a model is needed
+def import_libraries() -> None:
+    import sentence_transformers
+    import torch
+
+
+def load_model(name: str) -> "SentenceTransformer":
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(name)
+
+
+class Encoder:
+    backend = DEFAULT_BACKEND
+
+    def __init__(self, model: "SentenceTransformer"):
+        self.model = model
+
+    def dimension(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+
+    def encode(self, messages: list[str]) -> np.ndarray:
+        if len(messages) == 0:
+            return np.empty((0, self.dimension()), dtype=np.float32)
+
+        import torch
+        with torch.inference_mode():
+            return np.asarray(self.model.encode(messages, convert_to_numpy=True), dtype=np.float32)
+
+    def warm_up(self) -> float:
+        t = time.perf_counter()
+        for message in WARM_UP_MESSAGES:
+            self.encode([message])
+        self.encode(WARM_UP_MESSAGES)
+        return time.perf_counter() - t
+
+
+class QuantizedEncoder(Encoder):
+    # linear layers keep int8 weights and quantize their inputs on the fly, most of the time of a small transformer
+    # on the cpu is spent there
+    backend = "int8"
+
+    def __init__(self, model: "SentenceTransformer", inplace: bool = True):
+        import torch
+
+        # a copy keeps the original model usable, e.g. to compare the backends
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=inplace)
+        super(QuantizedEncoder, self).__init__(model)
+
+
+BACKENDS = {
+    Encoder.backend: Encoder,
+    QuantizedEncoder.backend: QuantizedEncoder
+}
+
+
+def create(backend: str, model: "SentenceTransformer", inplace: bool = True) -> Encoder:
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown encoder backend '{backend}', expected one of {', '.join(BACKENDS)}")
+
+    if backend == DEFAULT_BACKEND:
+        return Encoder(model)
+    return BACKENDS[backend](model, inplace)
+
+
+def leave_one_out(embeds: np.ndarray, entry_ids: np.ndarray, chunk_size: int = 1024) -> np.ndarray:
+    # entry id of the closest other message for every message
+    predictions = np.empty(len(embeds), dtype=entry_ids.dtype)
+
+    for start in range(0, len(embeds), chunk_size):
+        scores = embeds[start:start + chunk_size] @ embeds.T
+        rows = np.arange(len(scores))
+        scores[rows, rows + start] = -np.inf
+        predictions[start:start + chunk_size] = entry_ids[scores.argmax(axis=1)]
+
+    return predictions
+
+
+def compare(model_name: str, messages: list[str], entry_ids: np.ndarray, backends: Optional[list[str]] = None,
+            samples: int = 100) -> dict:
+    # accuracy and latency of every backend on a topic's own messages, relative to the first backend
+    backends = backends if backends is not None else list(BACKENDS)
+    model = load_model(model_name)
+
+    report = {}
+    baseline: Optional[tuple] = None
+
+    for backend in backends:
+        encoder = create(backend, model, inplace=False)
+        result = {"warm_up_s": encoder.warm_up()}
+
+        latencies = []
+        for message in messages[:samples]:
+            t = time.perf_counter()
+            encoder.encode([message])
+            latencies.append(time.perf_counter() - t)
+        result["p50_ms"] = float(np.percentile(latencies, 50) * 1000) if len(latencies) > 0 else None
+        result["p95_ms"] = float(np.percentile(latencies, 95) * 1000) if len(latencies) > 0 else None
+
+        t = time.perf_counter()
+        embeds = encoder.encode(messages)
+        duration = time.perf_counter() - t
+        result["messages_per_s"] = len(messages) / duration if duration > 0 else None
+
+        norms = np.linalg.norm(embeds, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        embeds = embeds / norms
+
+        predictions = leave_one_out(embeds, entry_ids)
+        result["leave_one_out_accuracy"] = float(np.mean(predictions == entry_ids)) if len(messages) > 1 else None
+
+        if baseline is None:
+            baseline = (embeds, predictions, result["p50_ms"])
+        else:
+            result["mean_cosine_to_" + backends[0]] = float(np.mean(np.sum(embeds * baseline[0], axis=1)))
+            result["top1_agreement"] = float(np.mean(predictions == baseline[1]))
+            if baseline[2] and result["p50_ms"]:
+                result["speedup"] = baseline[2] / result["p50_ms"]
+
+        report[backend] = result
+
+    return report
+
+
+if __name__ == "__main__":
+    # python -m core.encoder <topic> [backend...]: compares the backends on the topic's messages
+    import json
+    import sys
+
+    import core.storage
+    from core.classifier import DEFAULT_MODEL, BertClassifier
+    from core.files import Config, Data
+
+    config = Config()
+    core.storage.setup(core.storage.create(config.storage_engine(), config.storage_path()))
+
+    classifier = BertClassifier(Data(sys.argv[1]))
+    result = compare(DEFAULT_MODEL, classifier.messages, classifier.entry_ids, sys.argv[2:] or None)
+    print(json.dumps(result, indent=2))
@@ -1,72 +1,436 @@
+import asyncio
 import math
-from typing import Optional
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Callable, Optional
 
 import nextcord
 from nextcord.ext.commands import Bot
 
 import core.log as log
-from core.classifier import BertClassifier
-from core.files import Config, Data, LinkedFaqEntry
+from core import metrics
+from core import encoder, filter
+from core.cache import PredictionCache
+from core.classifier import BertClassifier, ModelRegistry
+from core.files import Config, Data, FaqEntry, LinkedFaqEntry, SharedData
+from core.index import IndexSettings
+from core.inference import InferenceEngine
 from core.ui import AutoResponseView
+from core.worker import RemoteClassifier, WorkerClient, authkey
 
 
 class Store:
     def __init__(self, bot: nextcord.ext.commands.Bot):
-        self.classifiers: dict = {}
+        self.started = time.perf_counter()
         self.config = Config()
+        self.models = ModelRegistry(self.config.embedding_cache(), self.config.encoder_backend())
+        self.inference = InferenceEngine(self.config.inference_workers(), self.config.torch_threads(),
+                                         self.config.batch_size(), self.config.batch_wait())
+        self.index_settings = IndexSettings(self.config.ann_min_corpus(), self.config.ann_probes(),
+                                            self.config.embedding_precision(), self.config.shared_indexes(),
+                                            self.config.lexical_floor())
+        # refits encode whole topics, so they get their own thread instead of delaying predictions
+        self.refits = ThreadPoolExecutor(max_workers=1, thread_name_prefix="refit")
+        # topics are served by a separate inference worker process if one is configured
+        address = self.config.inference_worker()
+        self.worker: Optional[WorkerClient] = WorkerClient(address, authkey(self.config.token())) if address else None
+        self.shared: Optional[SharedData] = None
+        self.classifiers: Topics = Topics(self)
         self.bot = bot
+        self.warm_up_task: Optional[asyncio.Task] = None
+
+    def warm_up(self) -> None:
+        # loads the encoder and every topic in the background, so the bot is online while they are loading
+        if self.warm_up_task is None:
+            self.warm_up_task = asyncio.get_running_loop().create_task(self.__warm_up__())
+
+    async def __warm_up__(self) -> None:
+        loop = asyncio.get_running_loop()
+        log.info(f"Connected {round(time.perf_counter() - self.started, 2)}s after start, warming up...")
+
+        if self.worker is not None:
+            if await loop.run_in_executor(self.refits, self.worker.available):
+                log.info(f"Using the inference worker at {self.worker.address}.")
+            else:
+                log.warning(f"The inference worker at {self.worker.address} is not available, "
+                            f"loading the encoder in this process.")
+                self.worker = None
+
+        try:
+            # the refit thread builds the topics right after, so they never wait for another thread
+            if self.worker is None:
+                t = time.perf_counter()
+                await loop.run_in_executor(self.refits, encoder.import_libraries)
+                log.info(f"Imported the encoder libraries in {round(time.perf_counter() - t, 2)}s.")
+
+                t = time.perf_counter()
+                await loop.run_in_executor(self.refits, self.models.get)
+                log.info(f"Loaded the encoder in {round(time.perf_counter() - t, 2)}s.")
+        except Exception as e:
+            log.error("Could not load the encoder:", e)
+            return
 
-    def load_classifiers(self) -> None:
-        self.classifiers = {}
-
+        t = time.perf_counter()
         for topic in self.config.topics():
-            self.classifiers[topic] = AutoFaq(
-                self.bot,
-                topic,
-                min_threshold=self.config.min_threshold(),
-                max_threshold=self.config.max_threshold()
-            )
+            self.classifiers.get(topic)
+        await asyncio.gather(*(faq.wait() for faq in list(self.classifiers.loaded.values())), return_exceptions=True)
+        log.info(f"Loaded {len(self.classifiers.values())} topics in {round(time.perf_counter() - t, 2)}s.")
+
+        log.info(f"Ready {round(time.perf_counter() - self.started, 2)}s after start.")
+
+    def load_classifiers(self) -> None:
+        # topics are loaded on first access, loaded topics keep answering with their old state until refitted. The
+        # shared data is reloaded in place, so topics which are not refitted yet save their nonsense into the same
+        # document instead of one that is overwritten later on.
+        if self.shared is not None:
+            self.shared.load()
+
+        for topic, faq in list(self.classifiers.loaded.items()):
+            if not self.config.has_topic(topic):
+                self.classifiers.loaded.pop(topic)
+                continue
+
+            faq.refit()
+
+    def shutdown(self) -> None:
+        self.refits.shutdown(wait=False, cancel_futures=True)
+
+    def create_classifier(self, topic: str) -> "AutoFaq":
+        if self.shared is None:
+            self.shared = SharedData()
+
+        return AutoFaq(
+            self.bot,
+            topic,
+            min_threshold=self.config.min_threshold(),
+            max_threshold=self.config.max_threshold(),
+            models=self.models,
+            inference=self.inference,
+            index_settings=self.index_settings,
+            prediction_cache_size=self.config.prediction_cache_size(),
+            shared=self.shared,
+            refits=self.refits,
+            worker=self.worker
+        )
+
+
+class Topics:
+    def __init__(self, store: Store):
+        self.store = store
+        self.loaded: dict[str, "AutoFaq"] = {}
+
+    def get(self, topic: str) -> Optional["AutoFaq"]:
+        # topics are built in the background when an event loop is running, they are None until they are ready
+        faq = self.loaded.get(topic)
+
+        if faq is None and self.store.config.has_topic(topic):
+            log.info(f"Loading topic '{topic}'...")
+            faq = self.store.create_classifier(topic)
+            self.loaded[topic] = faq
+
+        return faq if faq is not None and faq.ready() else None
+
+    def loading(self, topic: str) -> bool:
+        faq = self.loaded.get(topic)
+        return faq is not None and not faq.ready()
+
+    async def wait(self, topic: str) -> Optional["AutoFaq"]:
+        faq = self.get(topic)
+
+        if faq is None and self.loading(topic):
+            await self.loaded[topic].wait()
+            faq = self.get(topic)
+
+        return faq
+
+    def __getitem__(self, topic: str) -> "AutoFaq":
+        faq = self.get(topic)
+        if faq is None:
+            raise KeyError(topic)
+        return faq
+
+    def __contains__(self, topic: str) -> bool:
+        return topic in self.loaded or self.store.config.has_topic(topic)
+
+    def values(self) -> list["AutoFaq"]:
+        return [faq for faq in self.loaded.values() if faq.ready()]
+
+
+class RefitStatistics:
+    def __init__(self):
+        self.refits = 0
+        self.coalesced = 0
+        self.discarded = 0
+        self.failed = 0
+        self.last_duration = 0.0
+        self.total_duration = 0.0
+        # wall clock time at which the data of the served classifier was loaded
+        self.loaded_at: Optional[float] = None
+        # monotonic time of the oldest refit request that is not served yet
+        self.stale_since: Optional[float] = None
+
+    def staleness(self) -> float:
+        return 0 if self.stale_since is None else time.monotonic() - self.stale_since
+
+    def as_dict(self) -> dict:
+        return {
+            "refits": self.refits,
+            "coalesced": self.coalesced,
+            "discarded": self.discarded,
+            "failed": self.failed,
+            "last_duration_s": self.last_duration,
+            "mean_duration_s": self.total_duration / self.refits if self.refits > 0 else 0,
+            "loaded_at": self.loaded_at,
+            "staleness_s": self.staleness()
+        }
 
 
 class AutoFaq:
     def __init__(self, bot: Bot, topic: str, min_threshold: float = 0.3,
-                 max_threshold: float = 0.7, random_state: int = None):
+                 max_threshold: float = 0.7, random_state: int = None, models: Optional[ModelRegistry] = None,
+                 inference: Optional[InferenceEngine] = None, index_settings: Optional[IndexSettings] = None,
+                 prediction_cache_size: int = 1024, shared: Optional[SharedData] = None,
+                 refits: Optional[Executor] = None, worker: Optional[WorkerClient] = None):
         self.bot = bot
         self.topic = topic
         self.min_threshold = min_threshold
         self.max_threshold = max_threshold
         self.random_state = random_state
-
-        self.data = Data(topic)
+        self.models = models if models is not None else ModelRegistry()
+        self.inference = inference
+        self.index_settings = index_settings
+        self.predictions = PredictionCache(prediction_cache_size, topic)
+
+        self.shared = shared
+
+        self.refits = refits
+        self.worker = worker
+        self.refit_task: Optional[asyncio.Task] = None
+        self.refit_pending = False
+        self.refit_statistics = RefitStatistics()
+        # corpus updates run off the event loop, answers predicted while one runs might map to shifted entry ids
+        self.corpus_updates = 0
+        self.corpus_version = 0
+        # updates copy the corpus and swap it in, so two at once would lose one of them
+        self.corpus_lock = asyncio.Lock()
+
+        self.data = Data(topic, shared)
         self.data.repair_messages()
+        self.refit_statistics.loaded_at = time.time()
 
         self.classifier: Optional[BertClassifier] = None
-        self.__load__()
+        # (generation of the classifier, data, cleaned training message -> entry id)
+        self.__exact__: Optional[tuple[int, Data, dict[str, int]]] = None
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no event loop, e.g. in scripts
+            self.classifier = self.__build__(self.data)
+            self.__corpus_changed__()
+            return
+
+        self.refit_statistics.stale_since = time.monotonic()
+        self.refit_task = loop.create_task(self.__refit__(self.data))
+
+    def ready(self) -> bool:
+        return self.classifier is not None
+
+    async def wait(self) -> None:
+        # waits until the topic is built for the first time, or until building it failed
+        while not self.ready() and self.refit_task is not None:
+            await asyncio.shield(self.refit_task)
 
     def refit(self) -> None:
-        self.data = Data(self.topic)
-        self.__load__()
+        # reloads the topic and swaps in a new classifier once it is built, the old one keeps answering meanwhile
+        if self.refit_statistics.stale_since is None:
+            self.refit_statistics.stale_since = time.monotonic()
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no event loop, e.g. in scripts
+            t = time.perf_counter()
+            data = self.__reload__()
+            self.__swap__(data, self.__build__(data), t)
+            return
 
-    def __load__(self):
-        self.classifier = BertClassifier(self.data)
+        if self.refit_task is not None:
+            # the running refit starts another build when it is done
+            self.refit_pending = True
+            self.refit_statistics.coalesced += 1
+            return
 
-    async def check_message(self, content: str, reply_on: nextcord.Message) -> bool:
-        answer_id, p = self.classifier.predict(content)
+        self.refit_task = loop.create_task(self.__refit__())
+
+    async def __refit__(self, data: Optional[Data] = None) -> None:
+        try:
+            while True:
+                self.refit_pending = False
+
+                t = time.perf_counter()
+                if data is None:
+                    data = self.__reload__()
+                # after reloading, which might repair the shared nonsense
+                old, revision = self.data, self.data.corpus_revision()
+
+                try:
+                    loop = asyncio.get_running_loop()
+                    classifier = await loop.run_in_executor(self.refits, self.__build__, data)
+                except Exception as e:
+                    self.refit_statistics.failed += 1
+                    log.error(f"Refit of topic '{self.topic}' failed:", e)
+                    return
+
+                if self.data is not old or self.data.corpus_revision() != revision:
+                    # the served data changed during the build, so the new snapshot might have missed it
+                    self.refit_statistics.discarded += 1
+                    data = None
+                    continue
+
+                self.__swap__(data, classifier, t)
+                data = None
+
+                if not self.refit_pending:
+                    return
+        finally:
+            self.refit_task = None
+
+    def __reload__(self) -> Data:
+        data = Data(self.topic, self.shared)
+        data.repair_messages()
+        return data
+
+    def __build__(self, data: Data) -> BertClassifier:
+        if self.worker is not None:
+            return RemoteClassifier(self.worker, data, self.inference, refit=self.ready())
+        return BertClassifier(data, models=self.models, inference=self.inference, index_settings=self.index_settings)
+
+    def __swap__(self, data: Data, classifier: BertClassifier, started: float) -> None:
+        # both are replaced without yielding to the event loop, so no handler sees a mixed state
+        loaded = self.classifier is None
+        self.data = data
+        self.classifier = classifier
+
+        statistics = self.refit_statistics
+        duration = time.perf_counter() - started
+        statistics.refits += 1
+        statistics.last_duration = duration
+        statistics.total_duration += duration
+        statistics.loaded_at = time.time()
+        if not self.refit_pending:
+            statistics.stale_since = None
+
+        metrics.REFIT.observe(duration, self.topic)
+        self.__corpus_changed__()
+        if loaded:
+            log.info(f"Topic '{self.topic}' has been loaded in {round(duration, 2)}s.")
+        else:
+            log.info(f"Topic '{self.topic}' has been refitted in {round(duration, 2)}s.", statistics.as_dict())
+
+    def __corpus_changed__(self) -> None:
+        metrics.CORPUS_SIZE.set(self.classifier.size(), self.topic)
+
+    async def __update_corpus__(self, fn, *args) -> None:
+        # encoding the messages and updating the index take too long for the event loop
+        self.corpus_updates += 1
+        try:
+            async with self.corpus_lock:
+                if self.inference is not None:
+                    await self.inference.run(fn, *args)
+                else:
+                    fn(*args)
+        finally:
+            self.corpus_updates -= 1
+            self.corpus_version += 1
+
+        self.__corpus_changed__()
+
+    def exact_matches(self) -> dict[str, int]:
+        # rebuilt whenever the corpus changes, which is rare compared to incoming messages
+        classifier, data = self.classifier, self.data
+        if self.__exact__ is None or self.__exact__[0] != classifier.generation or self.__exact__[1] is not data:
+            self.__exact__ = classifier.generation, data, self.__build_exact_matches__(data)
+        return self.__exact__[2]
+
+    @staticmethod
+    def __build_exact_matches__(data: Data) -> dict[str, int]:
+        # entry id -1 is nonsense, messages labeled with different entries are left to the encoder
+        matches: dict[str, int] = {}
+        ambiguous = set()
+
+        labeled = [(m, -1) for m in data.nonsense()]
+        labeled += [(m, entry.id) for entry in data.linked_faq() for m in entry.messages()]
+
+        for message, entry_id in labeled:
+            if matches.setdefault(message, entry_id) != entry_id:
+                ambiguous.add(message)
+
+        for message in ambiguous:
+            matches.pop(message)
+
+        return matches
+
+    async def predict(self, content: str) -> (Optional[int], Optional[float]):
+        answer_id, p, _ = await self.__predict__(content)
+        return answer_id, p
+
+    async def __predict__(self, content: str) -> (Optional[int], Optional[float], bool):
+        classifier = self.classifier
+        key = self.data.clean_message(content)
+
+        # a message a moderator already labeled is answered or ignored without encoding it, the encoder would find
+        # the same message with a score of 1
+        entry_id = self.exact_matches().get(key) if filter.is_valid(key) else None
+        if entry_id is not None:
+            metrics.EXACT_MATCHES.inc(self.topic)
+            return (entry_id if entry_id != -1 else None), 1.0, True
+
+        answer_id, p = await self.predictions.get(classifier.generation, key,
+                                                  lambda: classifier.predict_async(content))
+        return answer_id, p, False
+
+    async def check_message(self, content: str, reply_on: nextcord.Message,
+                            reserve: Optional[Callable[[], bool]] = None) -> bool:
+        # reserve is called right before answering and returns False if the answer must not be sent, e.g. because of
+        # a rate limit
+        with metrics.CHECK_MESSAGE.time(self.topic):
+            return await self.__check_message__(content, reply_on, reserve)
+
+    async def __check_message__(self, content: str, reply_on: nextcord.Message,
+                                reserve: Optional[Callable[[], bool]] = None) -> bool:
+        # a refit might swap the data while predicting, the answer id belongs to the data it was predicted with
+        data = self.data
+        version = self.corpus_version
+        answer_id, p, exact = await self.__predict__(content)
+        metrics.PREDICTIONS.inc(self.topic)
+        path = ", exact" if exact else ""
+
+        if self.corpus_updates > 0 or self.corpus_version != version:
+            log.info("Incoming message:", content, "(skipped, the corpus changed while predicting)")
+            return False
 
         if answer_id is None:
             # message classified as nonsense
-            log.info("Incoming message:", content, "(nonsense" + (f", {round(p, 4)}" if p else "") + ")")
+            if p is not None:
+                metrics.NONSENSE.inc(self.topic)
+            log.info("Incoming message:", content, "(nonsense" + (f", {round(p, 4)}" if p else "") + path + ")")
             return False
 
         # change class index to answer_id
-        entry = self.data.faq_entry(answer_id)
-        threshold = self.calculate_threshold(answer_id)
+        entry = data.faq_entry(answer_id)
+        threshold = self.calculate_threshold(answer_id, data)
 
         log.info("Incoming message:", content,
-                 f"({entry.short()}, p={round(p, 4)}, threshold={threshold}, {p >= threshold})")
+                 f"({entry.short()}, p={round(p, 4)}, threshold={threshold}, {p >= threshold}{path})")
 
         if p >= threshold:
+            if reserve is not None and not reserve():
+                log.info("Incoming message:", content, "(not answered, rate limited)")
+                return False
+
             await self.send_faq(reply_on, answer_id, entry.answer(), True)
+            metrics.ANSWERS.inc(self.topic)
             return True
         else:
             return False
@@ -82,8 +446,10 @@ class AutoFaq:
     def apply_vote(self, answer_id: int, vote: int) -> None:
         if vote > 0:
             self.data.faq_entry(answer_id).vote_up()
+            metrics.VOTES.inc(self.topic, "up")
         elif vote < 0:
             self.data.faq_entry(answer_id).vote_down()
+            metrics.VOTES.inc(self.topic, "down")
 
     async def add_message_by_short(self, command: nextcord.Message, referenced: nextcord.Message,
                                    answer_abbreviation: str) -> None:
@@ -105,8 +471,8 @@ class AutoFaq:
             if entry.add_message(content):
                 log.info(f"The message '{referenced.content}' was added to the '{entry.short()}' dataset",
                          f"by {command.author.name}#{command.author.discriminator}.")
+                await self.__update_corpus__(self.classifier.append, entry.id, [content])
             await self.send_faq(referenced, message_id, entry.answer(), False)
-            self.refit()
             return
 
         await command.add_reaction("🤔")
@@ -120,8 +486,8 @@ class AutoFaq:
                     break
 
     async def add_message_to_nonsense(self, command: nextcord.Message, content: str, referenced: nextcord.Message):
-        self.data.add_nonsense(content)
-        self.refit()
+        if self.data.add_nonsense(content):
+            await self.__update_corpus__(self.classifier.append, -1, [content])
 
         log.info(f"The message '{referenced.content}' was added to the nonsense dataset",
                  f"by {command.author.name}#{command.author.discriminator}.")
@@ -152,8 +518,19 @@ class AutoFaq:
         self.data.add_faq_entry(answer, short)
         return True
 
-    def calculate_threshold(self, answer_id: int) -> Optional[float]:
-        entry = self.data.faq_entry(answer_id)
+    async def delete_entry(self, entry: LinkedFaqEntry) -> None:
+        self.data.delete_faq_entry(entry)
+        await self.__update_corpus__(self.classifier.remove, entry.id)
+
+    async def restore_entry(self, entry: FaqEntry) -> bool:
+        if not self.data.append_faq_entry(entry):
+            return False
+
+        await self.__update_corpus__(self.classifier.append, len(self.data.faq()) - 1, entry.messages())
+        return True
+
+    def calculate_threshold(self, answer_id: int, data: Optional[Data] = None) -> Optional[float]:
+        entry = (data if data is not None else self.data).faq_entry(answer_id)
 
         if entry.votes() == 0:
             return 0.5 * self.min_threshold + 0.5 * self.max_threshold
@@ -1,32 +1,28 @@
-import json
-import os
-import re
-from typing import Optional
+import fcntl
+from typing import Any, Callable, Optional
 
 import nextcord
 import numpy as np
 
+import core.storage
 from core import filter
+from core.storage import JsonStorage, SHARED_DOCUMENT, Storage, topic_document
 
 
 class File:
-    def __init__(self, file_name):
+    def __init__(self, file_name, storage: Optional[Storage] = None):
         self.file: dict = Optional[None]
         self.file_name = file_name
+        self.storage = storage if storage is not None else core.storage.storage
+        self.snapshot: Any = None
         self.load()
 
     def load(self) -> None:
-        path = f"{self.file_name}.json"
-
-        if os.path.exists(path):
-            with open(path, 'r') as f:
-                self.file = json.load(f)
-        else:
-            self.file = {}
+        self.file = self.storage.load(self.file_name)
+        self.snapshot = self.storage.snapshot(self.file_name, self.file)
 
     def save(self) -> None:
-        with open(f"{self.file_name}.json", 'w') as f:
-            json.dump(self.file, f, indent=2)
+        self.snapshot = self.storage.save(self.file_name, self.file, self.snapshot)
 
 
 class ChatData(File):
@@ -42,8 +38,9 @@ class ChatData(File):
 
 
 class Config(File):
-    def __init__(self):
-        super(Config, self).__init__("config")
+    def __init__(self, storage: Optional[Storage] = None):
+        # the config selects the storage engine for everything else, so it is read from config.json by default
+        super(Config, self).__init__("config", storage if storage is not None else JsonStorage())
 
     def token(self) -> str:
         return self.file["token"]
@@ -63,61 +60,160 @@ class Config(File):
     def max_threshold(self) -> float:
         return self.file["max_threshold"]
 
-    def topics(self) -> list[str]:
-        topics = []
-        for key in self.activated_channels().keys():
-            nested: dict = self.activated_channels()[key]
-            for topic in nested.values():
-                if topic not in topics:
-                    topics.append(topic)
-        return topics
+    def embedding_cache(self) -> Optional[str]:
+        return self.file.get("embedding_cache", "embeddings")
 
-    def get_topic(self, channel: nextcord.TextChannel) -> Optional[str]:
-        activated_channels: dict = self.activated_channels()
-        channels: dict = activated_channels.get(str(channel.guild.id))
+    def encoder_backend(self) -> str:
+        return self.file.get("encoder_backend", "fp32")
+
+    def inference_workers(self) -> int:
+        return self.file.get("inference_workers", 1)
+
+    def torch_threads(self) -> Optional[int]:
+        return self.file.get("torch_threads")
+
+    def batch_size(self) -> int:
+        return self.file.get("batch_size", 16)
+
+    def batch_wait(self) -> float:
+        return self.file.get("batch_wait_ms", 5) / 1000
+
+    def ann_min_corpus(self) -> int:
+        return self.file.get("ann_min_corpus", 20000)
+
+    def ann_probes(self) -> int:
+        return self.file.get("ann_probes", 16)
+
+    def embedding_precision(self) -> str:
+        return self.file.get("embedding_precision", "fp32")
+
+    def lexical_floor(self) -> Optional[float]:
+        return self.file.get("lexical_floor")
+
+    def user_reply_interval(self) -> float:
+        return self.file.get("user_reply_interval", 10)
+
+    def channel_replies_per_minute(self) -> Optional[float]:
+        return self.file.get("channel_replies_per_minute", 6)
+
+    def channel_reply_burst(self) -> int:
+        return self.file.get("channel_reply_burst", 3)
+
+    def guild_replies_per_minute(self) -> Optional[float]:
+        return self.file.get("guild_replies_per_minute", 30)
+
+    def guild_reply_burst(self) -> int:
+        return self.file.get("guild_reply_burst", 10)
+
+    def prediction_cache_size(self) -> int:
+        return self.file.get("prediction_cache_size", 1024)
+
+    def metrics_port(self) -> Optional[int]:
+        return self.file.get("metrics_port")
+
+    def inference_worker(self) -> Optional[str]:
+        return self.file.get("inference_worker")
+
+    def worker_metrics_port(self) -> Optional[int]:
+        return self.file.get("worker_metrics_port")
+
+    def shared_indexes(self) -> Optional[str]:
+        return self.file.get("shared_indexes")
+
+    def shard_count(self) -> Optional[int]:
+        return self.file.get("shard_count")
+
+    def shard_processes(self) -> Optional[list[list[int]]]:
+        return self.file.get("shard_processes")
+
+    def storage_engine(self) -> str:
+        return self.file.get("storage", "json")
 
-        if not channels:
-            return None
+    def storage_path(self) -> Optional[str]:
+        return self.file.get("storage_path")
 
-        return channels.get(str(channel.id))
+    def save_interval(self) -> float:
+        return self.file.get("save_interval", 2)
+
+    def load(self) -> None:
+        super(Config, self).load()
+        self.__route__()
+
+    def __route__(self) -> None:
+        # channel id -> topic, rebuilt whenever a channel is enabled or disabled
+        self.__routes__: dict[int, str] = {}
+        for channels in self.activated_channels().values():
+            for channel_id, topic in channels.items():
+                self.__routes__[int(channel_id)] = topic
+
+        # keeps the order of the first activation for autocompletion
+        self.__topics__: list[str] = list(dict.fromkeys(self.__routes__.values()))
+        self.__topic_set__: set[str] = set(self.__topics__)
+
+    def topics(self) -> list[str]:
+        return self.__topics__
+
+    def has_topic(self, topic: str) -> bool:
+        return topic in self.__topic_set__
+
+    def get_topic(self, channel: nextcord.TextChannel) -> Optional[str]:
+        return self.__routes__.get(channel.id)
 
     def is_channel_activated(self, channel: nextcord.TextChannel) -> bool:
-        activated_channels: dict = self.activated_channels()
-        channels: list = activated_channels.get(str(channel.guild.id))
-        return channels is not None and channel.id in channels
+        return channel.id in self.__routes__
+
+    def __update__(self, change: Callable[[], bool]) -> bool:
+        # every process of a sharded bot holds its own copy of the config, so a change is applied to the latest file
+        # under a lock instead of overwriting the changes of other processes. The routes of other processes stay as
+        # they are, a channel is only routed by the process which holds the shard of its guild.
+        with open(f"{self.file_name}.lock", 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self.load()
+                if not change():
+                    return False
+
+                self.__route__()
+                self.save()
+                return True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
 
     def enable_channel(self, channel: nextcord.TextChannel, topic: str) -> bool:
-        activated_channels: dict = self.activated_channels()
-        channels: dict = activated_channels.get(str(channel.guild.id))
+        def change() -> bool:
+            activated_channels: dict = self.activated_channels()
+            channels: dict = activated_channels.get(str(channel.guild.id))
 
-        if not channels:
-            channels = {}
-            activated_channels[str(channel.guild.id)] = channels
+            if not channels:
+                channels = {}
+                activated_channels[str(channel.guild.id)] = channels
 
-        if str(channel.id) in channels:
-            return False
+            if str(channel.id) in channels:
+                return False
 
-        channels[str(channel.id)] = topic
-        self.save()
-        return True
+            channels[str(channel.id)] = topic
+            return True
+
+        return self.__update__(change)
 
     def disable_channel(self, channel: nextcord.TextChannel) -> bool:
-        activated_channels: dict = self.activated_channels()
-        channels: dict = activated_channels.get(str(channel.guild.id))
+        def change() -> bool:
+            activated_channels: dict = self.activated_channels()
+            channels: dict = activated_channels.get(str(channel.guild.id))
 
-        if not channels or str(channel.id) not in channels:
-            return False
+            if not channels or str(channel.id) not in channels:
+                return False
 
-        channels.pop(str(channel.id))
-        if len(channels) == 0:
-            activated_channels.pop(str(channel.guild.id))
+            channels.pop(str(channel.id))
+            if len(channels) == 0:
+                activated_channels.pop(str(channel.guild.id))
+            return True
 
-        self.save()
-        return True
+        return self.__update__(change)
 
 
 class FaqEntry:
-    def __init__(self, data: dict, file: File):
+    def __init__(self, data: dict, file: "Data"):
         self.data = data
         self.file = file
 
@@ -129,11 +225,13 @@ class FaqEntry:
             return False
 
         self.messages().append(message)
+        self.file.message_set(self.data).add(message)
+        self.file.corpus_changed()
         self.file.save()
         return True
 
     def contains_message(self, message: str) -> bool:
-        return message in self.messages()
+        return message in self.file.message_set(self.data)
 
     def answer(self) -> str:
         return self.data["answer"]
@@ -159,31 +257,137 @@ class FaqEntry:
         return self.data["short"]
 
     def set_short(self, text: str):
+        old = self.short()
         self.data["short"] = text
+        self.file.reindex_entry(self.data, old, self.answer())
 
     def set_answer(self, text: str):
+        old = self.answer()
         self.data["answer"] = text
+        self.file.reindex_entry(self.data, self.short(), old)
 
 
 class LinkedFaqEntry(FaqEntry):
-    def __init__(self, entry_id: int, data: dict, file: File):
+    def __init__(self, entry_id: int, data: dict, file: "Data"):
         super().__init__(data, file)
         self.id = entry_id
 
 
+class SharedData(File):
+    def __init__(self, storage: Optional[Storage] = None):
+        self.__nonsense__: Optional[set[str]] = None
+        # counts the changes of the nonsense and fill words, see Data.corpus_revision
+        self.corpus_changes = 0
+        super(SharedData, self).__init__(SHARED_DOCUMENT, storage)
+
+    def load(self) -> None:
+        super(SharedData, self).load()
+        self.reindex()
+        self.corpus_changes += 1
+
+    def reindex(self) -> None:
+        # has to be called whenever the nonsense list is modified directly
+        self.__nonsense__ = None
+
+    def fill_words(self) -> list[str]:
+        return self.file.setdefault("fill_words", [])
+
+    def nonsense(self) -> list[str]:
+        return self.file.setdefault("nonsense", [])
+
+    def contains_nonsense(self, text: str) -> bool:
+        if self.__nonsense__ is None:
+            self.__nonsense__ = set(self.nonsense())
+        return text in self.__nonsense__
+
+    def add_nonsense(self, text: str) -> bool:
+        if self.contains_nonsense(text):
+            return False
+
+        self.nonsense().append(text)
+        self.__nonsense__.add(text)
+        self.corpus_changes += 1
+        self.save()
+        return True
+
+
 class Data(File):
-    def __init__(self, topic: str):
-        super(Data, self).__init__("data")
+    def __init__(self, topic: str, shared: Optional[SharedData] = None, storage: Optional[Storage] = None):
+        # short -> entry id and answer -> entry id, built on first use
+        self.__shorts__: Optional[dict[str, int]] = None
+        self.__answers__: Optional[dict[str, int]] = None
+        # messages of every entry, keyed by the identity of the entry's dict
+        self.__messages__: dict[int, set[str]] = {}
+        # counts the changes of messages and entries, votes and edits of shorts and answers do not count
+        self.corpus_changes = 0
+
+        super(Data, self).__init__(topic_document(topic), storage)
         self.topic = topic
+        self.shared = shared if shared is not None else SharedData(storage)
+        self.__normalizer__: Optional[filter.Normalizer] = None
 
-    def faq(self) -> list[dict]:
-        topics: dict = self.file["faq"]
-        faq = topics.get(self.topic)
+    def load(self) -> None:
+        super(Data, self).load()
+        self.reindex()
+
+    def reindex(self) -> None:
+        # has to be called whenever entries are modified without the methods of Data and FaqEntry
+        self.__shorts__ = None
+        self.__answers__ = None
+        self.__messages__ = {}
+
+    def corpus_changed(self) -> None:
+        self.corpus_changes += 1
+
+    def corpus_revision(self) -> (int, int):
+        # changes whenever a classifier built from this data would be built differently
+        return self.corpus_changes, self.shared.corpus_changes
+
+    def __build_index__(self) -> None:
+        if self.__shorts__ is not None:
+            return
+
+        self.__shorts__ = {}
+        self.__answers__ = {}
+
+        # the first entry wins, just like a linear search would
+        for entry_id, e in enumerate(self.faq()):
+            self.__shorts__.setdefault(e["short"], entry_id)
+            self.__answers__.setdefault(e["answer"], entry_id)
+
+    def __index_appended__(self, entry: dict) -> None:
+        if self.__shorts__ is not None:
+            entry_id = len(self.faq()) - 1
+            self.__shorts__.setdefault(entry["short"], entry_id)
+            self.__answers__.setdefault(entry["answer"], entry_id)
+
+    def reindex_entry(self, entry: dict, old_short: str, old_answer: str) -> None:
+        if self.__shorts__ is None:
+            return
+
+        entry_id = self.__shorts__.get(old_short)
+        if entry_id is None or self.faq()[entry_id] is not entry or self.__answers__.get(old_answer) != entry_id:
+            # e.g. the entry shares its short with another one
+            self.reindex()
+            return
+
+        self.__shorts__.pop(old_short)
+        self.__answers__.pop(old_answer)
+        self.__shorts__.setdefault(entry["short"], entry_id)
+        self.__answers__.setdefault(entry["answer"], entry_id)
 
-        if faq:
-            return faq
-        else:
-            return []
+    def message_set(self, entry: dict) -> set[str]:
+        messages = self.__messages__.get(id(entry))
+
+        if messages is None:
+            messages = set(entry["messages"])
+            self.__messages__[id(entry)] = messages
+
+        return messages
+
+    def faq(self) -> list[dict]:
+        # the list has to be part of the file, otherwise the first entry of a new topic would never be saved
+        return self.file.setdefault("faq", [])
 
     def is_valid(self) -> bool:
         return len(self.faq()) > 0
@@ -205,22 +409,14 @@ class Data(File):
     def faq_entry_by_short(self, short: str) -> Optional[LinkedFaqEntry]:
         short = short.lower().strip()
 
-        entry_id = 0
-        for e in self.faq():
-            entry = LinkedFaqEntry(entry_id, e, self)
-            if entry.short() == short:
-                return entry
-            entry_id += 1
-        return None
+        self.__build_index__()
+        entry_id = self.__shorts__.get(short)
+        return self.faq_entry(entry_id) if entry_id is not None else None
 
     def faq_entry_by_answer(self, answer: str) -> Optional[LinkedFaqEntry]:
-        entry_id = 0
-        for e in self.faq():
-            entry = LinkedFaqEntry(entry_id, e, self)
-            if entry.answer() == answer:
-                return entry
-            entry_id += 1
-        return None
+        self.__build_index__()
+        entry_id = self.__answers__.get(answer)
+        return self.faq_entry(entry_id) if entry_id is not None else None
 
     def add_faq_entry(self, answer: str, short: str) -> None:
         entry: dict = {
@@ -232,6 +428,8 @@ class Data(File):
         }
 
         self.faq().append(entry)
+        self.__index_appended__(entry)
+        self.corpus_changed()
         self.save()
 
     def append_faq_entry(self, entry: FaqEntry) -> bool:
@@ -239,28 +437,32 @@ class Data(File):
             return False
 
         self.faq().append(entry.data)
+        self.__index_appended__(entry.data)
+        self.corpus_changed()
         self.save()
         return True
 
     def delete_faq_entry(self, entry: LinkedFaqEntry):
-        self.faq().pop(entry.id)
+        removed = self.faq().pop(entry.id)
+        self.corpus_changed()
         self.save()
 
+        # the ids of all following entries shift
+        self.__shorts__ = None
+        self.__answers__ = None
+        self.__messages__.pop(id(removed), None)
+
     def fill_words(self) -> list[str]:
-        return self.file["fill_words"]
+        return self.shared.fill_words()
 
     def nonsense(self) -> list[str]:
-        return self.file["nonsense"]
+        return self.shared.nonsense()
 
     def contains_nonsense(self, text: str) -> bool:
-        return text in self.nonsense()
-
-    def add_nonsense(self, text: str) -> None:
-        if self.contains_nonsense(text):
-            return
+        return self.shared.contains_nonsense(text)
 
-        self.nonsense().append(text)
-        self.save()
+    def add_nonsense(self, text: str) -> bool:
+        return self.shared.add_nonsense(text)
 
     def repair_messages(self) -> None:
         changed = False
@@ -271,18 +473,23 @@ class Data(File):
             if self.__repair_message_list__(messages):
                 changed = True
 
-        if self.__repair_message_list__(self.nonsense()):
-            changed = True
-
         if changed:
+            self.reindex()
+            self.corpus_changed()
             self.save()
 
+        if self.__repair_message_list__(self.nonsense()):
+            self.shared.reindex()
+            self.shared.corpus_changes += 1
+            self.shared.save()
+
     def __repair_message_list__(self, messages: [str]) -> bool:
         changed = False
         pop = []
+        cleaned = self.clean_many(messages)
 
         for i in range(len(messages)):
-            new_message = self.clean_message(messages[i])
+            new_message = cleaned[i]
 
             if filter.is_valid(new_message):
                 if messages[i] != new_message:
@@ -309,14 +516,14 @@ class Data(File):
 
         return changed
 
-    def clean_message(self, message: str) -> str:
-        message = message.lower()
-        message = re.sub("[^a-z0-9 ]*", "", message)  # remove illegal characters
-        message = re.sub(r"\b[0-9]+\b", "", message)  # remove words only containing numbers (e.g. @ mentions)
+    def normalizer(self) -> filter.Normalizer:
+        # the patterns are compiled once and only rebuilt if the fill words change
+        if self.__normalizer__ is None or self.__normalizer__.fill_words != self.fill_words():
+            self.__normalizer__ = filter.Normalizer(self.fill_words())
+        return self.__normalizer__
 
-        for fill_word in self.fill_words():
-            message = re.sub(r"\b" + fill_word + r"\b", "", message)
+    def clean_message(self, message: str) -> str:
+        return self.normalizer().clean(message)
 
-        message = re.sub(r" +", " ", message)
-        message = message.strip()
-        return message
+    def clean_many(self, messages: list[str]) -> list[str]:
+        return self.normalizer().clean_many(messages)
@@ -1,5 +1,12 @@
+import functools
+import re
+
 from core.magic import MAX_WORD_COUNT, MIN_WORD_COUNT, MAX_WORD_LENGTH
 
+ILLEGAL_CHARACTERS = re.compile("[^a-z0-9 ]*")
+NUMBER_WORDS = re.compile(r"\b[0-9]+\b")  # words only containing numbers (e.g. @ mentions)
+SPACES = re.compile(r" +")
+
 
 def get_max_word_length(s: str) -> int:
     value = 0
@@ -16,3 +23,29 @@ def is_valid(message: str) -> bool:
     word_count = len(message.split(" "))
     max_word_length = get_max_word_length(message)
     return MIN_WORD_COUNT <= word_count <= MAX_WORD_COUNT and max_word_length <= MAX_WORD_LENGTH
+
+
+class Normalizer:
+    def __init__(self, fill_words: list[str], cache_size: int = 4096):
+        self.fill_words = list(fill_words)
+
+        # one alternation for all fill words instead of one regex per word; longer words first
+        words = sorted(set(fill_words), key=len, reverse=True)
+        self.fill_word_pattern = re.compile(r"\b(?:" + "|".join(re.escape(w) for w in words) + r")\b") \
+            if len(words) > 0 else None
+
+        self.clean = functools.lru_cache(maxsize=cache_size)(self.__clean__)
+
+    def __clean__(self, message: str) -> str:
+        message = message.lower()
+        message = ILLEGAL_CHARACTERS.sub("", message)
+        message = NUMBER_WORDS.sub("", message)
+
+        if self.fill_word_pattern:
+            message = self.fill_word_pattern.sub("", message)
+
+        message = SPACES.sub(" ", message)
+        return message.strip()
+
+    def clean_many(self, messages: list[str]) -> list[str]:
+        return [self.clean(m) for m in messages]
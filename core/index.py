@@ -0,0 +1,330 @@
+import os
+import time
+from typing import Optional
+
+import numpy as np
+
+# corpora below this size are always searched exhaustively
+DEFAULT_MIN_SIZE = 20000
+DEFAULT_PROBES = 16
+DEFAULT_PRECISION = "fp32"
+PRECISIONS = ("fp32", "fp16", "int8")
+
+
+class IndexSettings:
+    def __init__(self, min_size: int = DEFAULT_MIN_SIZE, probes: int = DEFAULT_PROBES,
+                 precision: str = DEFAULT_PRECISION, shared_directory: Optional[str] = None,
+                 lexical_floor: Optional[float] = None):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown embedding precision '{precision}', expected one of {', '.join(PRECISIONS)}")
+
+        self.min_size = min_size
+        self.probes = probes
+        self.precision = precision
+        # corpus embeddings are written to this directory and memory-mapped, so processes share them
+        self.shared_directory = shared_directory
+        # messages sharing less of their n-grams with the corpus are not encoded at all, see core.lexical
+        self.lexical_floor = lexical_floor
+
+
+class Embeddings:
+    # normalized corpus embeddings, stored as float32, float16 or int8 with one scale per row. Indexing decodes rows
+    # to float32, scores are computed on the compact rows chunk by chunk, so the corpus is never decoded as a whole.
+    def __init__(self, data: np.ndarray, scales: Optional[np.ndarray] = None, precision: str = DEFAULT_PRECISION):
+        self.data = data
+        self.scales = scales
+        self.precision = precision
+
+    @staticmethod
+    def compress(embeds: np.ndarray, precision: str = DEFAULT_PRECISION) -> "Embeddings":
+        embeds = np.asarray(embeds, dtype=np.float32)
+
+        if precision == "fp16":
+            return Embeddings(embeds.astype(np.float16), None, precision)
+
+        if precision == "int8":
+            scales = np.abs(embeds).max(axis=1) if len(embeds) > 0 else np.empty(0, dtype=np.float32)
+            scales[scales == 0] = 1
+            data = np.round(embeds / scales[:, None] * 127).astype(np.int8)
+            return Embeddings(data, (scales / 127).astype(np.float32), precision)
+
+        return Embeddings(embeds, None, precision)
+
+    @staticmethod
+    def load(path: str, precision: str = DEFAULT_PRECISION) -> Optional["Embeddings"]:
+        # read-only memory map of a saved corpus, the pages are shared with every other process mapping it
+        if not os.path.exists(f"{path}.npy"):
+            return None
+
+        scales = np.load(f"{path}.scales.npy", mmap_mode="r") if precision == "int8" else None
+        return Embeddings(np.load(f"{path}.npy", mmap_mode="r"), scales, precision)
+
+    def save(self, path: str) -> "Embeddings":
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        # the scales are written first, so a complete data file always has its scales
+        for suffix, array in ((".scales.npy", self.scales), (".npy", self.data)):
+            if array is None:
+                continue
+
+            tmp_path = f"{path}{suffix}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(tmp_path, f"{path}{suffix}")
+
+        return Embeddings.load(path, self.precision)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __getitem__(self, rows) -> np.ndarray:
+        embeds = self.data[rows].astype(np.float32, copy=False)
+        if self.scales is not None:
+            embeds = embeds * self.scales[rows][..., None]
+        return embeds
+
+    def nbytes(self) -> int:
+        return self.data.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def take(self, keep: np.ndarray) -> "Embeddings":
+        return Embeddings(self.data[keep], self.scales[keep] if self.scales is not None else None, self.precision)
+
+    def appended(self, embeds: np.ndarray) -> "Embeddings":
+        added = Embeddings.compress(embeds, self.precision)
+        scales = None if self.scales is None else np.concatenate([self.scales, added.scales])
+        return Embeddings(np.vstack([self.data, added.data]), scales, self.precision)
+
+    def scores(self, queries: np.ndarray, chunk_size: int = 4096) -> np.ndarray:
+        if self.precision == "fp32":
+            return queries @ self.data.T
+
+        scores = np.empty((len(queries), len(self.data)), dtype=np.float32)
+        for start in range(0, len(self.data), chunk_size):
+            chunk = self.data[start:start + chunk_size].astype(np.float32)
+            scores[:, start:start + chunk_size] = queries @ chunk.T
+
+        if self.scales is not None:
+            scores *= self.scales
+        return scores
+
+    def score_rows(self, rows: np.ndarray, query: np.ndarray) -> np.ndarray:
+        scores = self.data[rows].astype(np.float32, copy=False) @ query
+        if self.scales is not None:
+            scores *= self.scales[rows]
+        return scores
+
+
+class ExactIndex:
+    def __init__(self, embeds: Embeddings):
+        self.embeds = embeds
+
+    def scores(self, queries: np.ndarray) -> list[(Optional[np.ndarray], np.ndarray)]:
+        # (candidate rows, scores) per query; None means every row of the corpus
+        return [(None, s) for s in self.embeds.scores(queries)]
+
+    def appended(self, embeds: Embeddings):
+        return ExactIndex(embeds)
+
+    def subset(self, embeds: Embeddings, keep: np.ndarray):
+        return ExactIndex(embeds)
+
+
+class IvfIndex:
+    # inverted file index: rows are clustered around normalized centroids (spherical k-means) and a query only
+    # scores the rows of its closest clusters
+    def __init__(self, embeds: Embeddings, probes: int = DEFAULT_PROBES, centroids: Optional[np.ndarray] = None,
+                 assignments: Optional[np.ndarray] = None, trained_size: Optional[int] = None,
+                 random_state: int = 0):
+        self.embeds = embeds
+        self.probes = probes
+
+        if centroids is None:
+            centroids = self.__train__(embeds, max(1, int(np.sqrt(len(embeds)))), random_state)
+            assignments = None
+            trained_size = len(embeds)
+
+        self.centroids = centroids
+        self.trained_size = trained_size
+
+        if assignments is None:
+            assignments = self.__assign__(embeds)
+        self.assignments = assignments
+
+        self.order = np.argsort(assignments, kind="stable")
+        self.offsets = np.searchsorted(assignments[self.order], np.arange(len(centroids) + 1))
+
+    def __assign__(self, embeds: Embeddings, start: int = 0, chunk_size: int = 4096) -> np.ndarray:
+        assignments = np.empty(len(embeds) - start, dtype=np.int32)
+        for offset in range(0, len(assignments), chunk_size):
+            chunk = embeds[start + offset:start + offset + chunk_size]
+            assignments[offset:offset + chunk_size] = (chunk @ self.centroids.T).argmax(axis=1)
+        return assignments
+
+    @staticmethod
+    def __train__(embeds: Embeddings, lists: int, random_state: int, iterations: int = 10) -> np.ndarray:
+        rng = np.random.default_rng(random_state)
+        sample = embeds[rng.choice(len(embeds), min(len(embeds), lists * 64), replace=False)]
+        centroids = sample[rng.choice(len(sample), lists, replace=False)].copy()
+
+        for _ in range(iterations):
+            assignments = (sample @ centroids.T).argmax(axis=1)
+
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+
+            # empty clusters are restarted on random samples
+            empty = np.flatnonzero(np.bincount(assignments, minlength=lists) == 0)
+            sums[empty] = sample[rng.choice(len(sample), len(empty))]
+
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            centroids = (sums / norms).astype(np.float32)
+
+        return np.ascontiguousarray(centroids)
+
+    def scores(self, queries: np.ndarray) -> list[(Optional[np.ndarray], np.ndarray)]:
+        probes = min(self.probes, len(self.centroids))
+        closest = np.argpartition(-(queries @ self.centroids.T), probes - 1, axis=1)[:, :probes]
+
+        results = []
+        for query, lists in zip(queries, closest):
+            rows = np.concatenate([self.order[self.offsets[i]:self.offsets[i + 1]] for i in lists])
+            results.append((rows, self.embeds.score_rows(rows, query)))
+        return results
+
+    def appended(self, embeds: Embeddings):
+        if len(embeds) > 2 * self.trained_size:
+            # the clusters were trained on a much smaller corpus
+            return IvfIndex(embeds, self.probes)
+
+        assignments = np.concatenate([self.assignments, self.__assign__(embeds, len(self.assignments))])
+        return IvfIndex(embeds, self.probes, self.centroids, assignments, self.trained_size)
+
+    def subset(self, embeds: Embeddings, keep: np.ndarray):
+        return IvfIndex(embeds, self.probes, self.centroids, self.assignments[keep], self.trained_size)
+
+
+def build_index(embeds: Embeddings, settings: IndexSettings, previous=None):
+    approximate = len(embeds) >= settings.min_size
+
+    if not approximate:
+        return ExactIndex(embeds)
+    if isinstance(previous, IvfIndex):
+        return previous.appended(embeds)
+    return IvfIndex(embeds, settings.probes)
+
+
+def top_k(results: list[(Optional[np.ndarray], np.ndarray)], k: int) -> list[np.ndarray]:
+    rows = []
+    for candidates, scores in results:
+        n = min(k, len(scores))
+        top = np.argpartition(-scores, n - 1)[:n]
+        top = top[np.argsort(-scores[top])]
+        rows.append(top if candidates is None else candidates[top])
+    return rows
+
+
+def without(results: list[(Optional[np.ndarray], np.ndarray)], row: int) -> list[(np.ndarray, np.ndarray)]:
+    # drops a corpus row from the candidates, e.g. the row a query was taken from
+    filtered = []
+    for candidates, scores in results:
+        rows = np.arange(len(scores)) if candidates is None else candidates
+        keep = rows != row
+        filtered.append((rows[keep], scores[keep]))
+    return filtered
+
+
+def benchmark(embeds: Embeddings, queries: np.ndarray, k: int = 10, probes: int = DEFAULT_PROBES,
+              rows: Optional[np.ndarray] = None) -> dict:
+    # rows are the corpus rows the queries were taken from, they are left out of the results. Otherwise exact search
+    # finds every query itself and the IVF index finds it in the first list it probes, so both always agree.
+    t = time.perf_counter()
+    ivf = IvfIndex(embeds, probes)
+    build_time = time.perf_counter() - t
+
+    def search(index, i: int) -> np.ndarray:
+        results = index.scores(queries[i][None])
+        return top_k(results if rows is None else without(results, rows[i]), k)[0]
+
+    # queries are searched one by one, like incoming messages are
+    exact_index = ExactIndex(embeds)
+    t = time.perf_counter()
+    exact = [search(exact_index, i) for i in range(len(queries))]
+    exact_time = time.perf_counter() - t
+
+    t = time.perf_counter()
+    approximate = [search(ivf, i) for i in range(len(queries))]
+    approximate_time = time.perf_counter() - t
+
+    # a query with nothing left to find has nothing to compare
+    pairs = [(e, a) for e, a in zip(exact, approximate) if len(e) > 0]
+    recall = np.mean([len(np.intersect1d(e, a)) / len(e) for e, a in pairs]) if len(pairs) > 0 else None
+    top1 = np.mean([len(a) > 0 and e[0] == a[0] for e, a in pairs]) if len(pairs) > 0 else None
+
+    return {
+        "corpus_size": len(embeds),
+        "queries": len(queries),
+        "k": k,
+        "lists": len(ivf.centroids),
+        "probes": probes,
+        "build_ms": build_time * 1000,
+        "exact_ms_per_query": exact_time * 1000 / len(queries),
+        "approximate_ms_per_query": approximate_time * 1000 / len(queries),
+        f"recall@{k}": float(recall) if recall is not None else None,
+        "top1_agreement": float(top1) if top1 is not None else None
+    }
+
+
+def compare_precisions(embeds: np.ndarray, entry_ids: np.ndarray, chunk_size: int = 1024) -> dict:
+    # memory and leave-one-out top-1 agreement of every precision compared to float32
+    baseline = None
+    report = {}
+
+    for precision in PRECISIONS:
+        compact = Embeddings.compress(embeds, precision)
+
+        t = time.perf_counter()
+        best = np.empty(len(compact), dtype=np.int64)
+        for start in range(0, len(compact), chunk_size):
+            scores = compact.scores(embeds[start:start + chunk_size])
+            rows = np.arange(len(scores))
+            scores[rows, rows + start] = -np.inf
+            best[start:start + chunk_size] = scores.argmax(axis=1)
+        duration = time.perf_counter() - t
+
+        if baseline is None:
+            baseline = compact.nbytes(), best
+
+        report[precision] = {
+            "bytes": compact.nbytes(),
+            "saved_bytes": baseline[0] - compact.nbytes(),
+            "ms_per_query": duration * 1000 / len(compact) if len(compact) > 0 else None,
+            "top1_row_agreement": float(np.mean(best == baseline[1])) if len(compact) > 1 else None,
+            "top1_entry_agreement": float(np.mean(entry_ids[best] == entry_ids[baseline[1]]))
+            if len(compact) > 1 else None
+        }
+
+    return report
+
+
+if __name__ == "__main__":
+    # python -m core.index <topic> [k] [probes]: compares exact and approximate search and the embedding precisions on
+    # the topic's messages, leaving out the message every query was taken from
+    import json
+    import sys
+
+    import core.storage
+    from core.classifier import BertClassifier
+    from core.files import Config, Data
+
+    config = Config()
+    core.storage.setup(core.storage.create(config.storage_engine(), config.storage_path()))
+
+    classifier = BertClassifier(Data(sys.argv[1]))
+    embeds = classifier.embeds[:]
+    result = benchmark(classifier.embeds, embeds,
+                       int(sys.argv[2]) if len(sys.argv) > 2 else 10,
+                       int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_PROBES,
+                       np.arange(len(embeds)))
+    result["precision"] = compare_precisions(embeds, classifier.entry_ids)
+    print(json.dumps(result, indent=2))
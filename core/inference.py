@@ -0,0 +1,149 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+import core.log as log
+from core import metrics
+
+
+class BatchStatistics:
+    def __init__(self):
+        self.batches = 0
+        self.requests = 0
+        self.max_batch_size = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def add(self, batch_size: int, waits: list[float]) -> None:
+        self.batches += 1
+        self.requests += batch_size
+        self.max_batch_size = max(self.max_batch_size, batch_size)
+        self.total_wait += sum(waits)
+        self.max_wait = max(self.max_wait, max(waits))
+
+    def mean_batch_size(self) -> float:
+        return self.requests / self.batches if self.batches > 0 else 0
+
+    def mean_wait(self) -> float:
+        return self.total_wait / self.requests if self.requests > 0 else 0
+
+    def as_dict(self) -> dict:
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "mean_batch_size": self.mean_batch_size(),
+            "max_batch_size": self.max_batch_size,
+            "mean_wait_ms": self.mean_wait() * 1000,
+            "max_wait_ms": self.max_wait * 1000
+        }
+
+
+class PendingPrediction:
+    def __init__(self, classifier, message: str, future: asyncio.Future):
+        self.classifier = classifier
+        self.message = message
+        self.future = future
+        self.queued_at = time.perf_counter()
+
+
+class InferenceEngine:
+    def __init__(self, workers: int = 1, torch_threads: Optional[int] = None,
+                 batch_size: int = 1, batch_wait: float = 0.0):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="inference")
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+
+        self.pending: list[PendingPrediction] = []
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        self.statistics = BatchStatistics()
+
+        if torch_threads:
+            # only imported when needed, importing torch takes seconds
+            import torch
+            torch.set_num_threads(torch_threads)
+
+    async def run(self, fn: Callable, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args))
+
+    async def predict(self, classifier, message: str) -> (Optional[int], int):
+        if self.batch_size <= 1:
+            return await self.run(classifier.predict, message)
+
+        message = classifier.prepare(message)
+        if message is None:
+            return None, None
+
+        loop = asyncio.get_running_loop()
+        pending = PendingPrediction(classifier, message, loop.create_future())
+        self.pending.append(pending)
+
+        if len(self.pending) >= self.batch_size:
+            self.__flush__()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.batch_wait, self.__flush__)
+
+        return await pending.future
+
+    def __flush__(self) -> None:
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        batch = self.pending
+        self.pending = []
+
+        if len(batch) > 0:
+            t = time.perf_counter()
+            self.statistics.add(len(batch), [t - p.queued_at for p in batch])
+            if self.statistics.batches % 1000 == 0:
+                log.info("Inference batch statistics:", self.statistics.as_dict())
+            asyncio.get_running_loop().create_task(self.__process__(batch))
+
+    async def __process__(self, batch: list[PendingPrediction]) -> None:
+        try:
+            results = await self.run(self.__predict_batch__, batch)
+        except Exception as e:
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_exception(e)
+            return
+
+        for pending, result in zip(batch, results):
+            if not pending.future.done():
+                pending.future.set_result(result)
+
+    @staticmethod
+    def __predict_batch__(batch: list[PendingPrediction]) -> list:
+        results = [None] * len(batch)
+
+        # topics share their encoder, so usually the whole batch is encoded in a single call
+        groups: dict[int, list[int]] = {}
+        for i in range(len(batch)):
+            groups.setdefault(id(batch[i].classifier.classifier), []).append(i)
+
+        for indices in groups.values():
+            with metrics.ENCODE.time():
+                embeds = batch[indices[0]].classifier.encode([batch[i].message for i in indices])
+
+            # every topic scores all of its queries with a single matrix product
+            topics: dict[int, list[int]] = {}
+            for j in range(len(indices)):
+                topics.setdefault(id(batch[indices[j]].classifier), []).append(j)
+
+            for positions in topics.values():
+                classifier = batch[indices[positions[0]]].classifier
+                with metrics.SIMILARITY.time():
+                    rankings = classifier.rank(embeds[positions], 1, entries=False)
+
+                for j, ranking in zip(positions, rankings):
+                    results[indices[j]] = ranking.best()
+
+        return results
+
+    def shutdown(self) -> None:
+        log.info("Inference batch statistics:", self.statistics.as_dict())
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,78 @@
+import zlib
+from typing import Optional
+
+import numpy as np
+
+DEFAULT_N = 3
+DEFAULT_BUCKETS = 1 << 18
+# floors reported by the benchmark to pick one for a topic
+FLOORS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9)
+
+
+def ngrams(message: str, n: int = DEFAULT_N, buckets: int = DEFAULT_BUCKETS) -> np.ndarray:
+    # hashed character n-grams of a cleaned message, crc32 is stable across processes unlike hash()
+    message = f" {message} "
+    grams = {message[i:i + n] for i in range(max(len(message) - n + 1, 1))}
+    return np.fromiter((zlib.crc32(g.encode("utf-8")) % buckets for g in grams), dtype=np.int64, count=len(grams))
+
+
+# A message is only encoded if enough of its n-grams occur in the topic's corpus. Rare n-grams weigh more, so a
+# message sharing only " th" and "the" with the corpus is not plausible, while one sharing "plugin" is.
+class LexicalIndex:
+    def __init__(self, messages: list[str], n: int = DEFAULT_N, buckets: int = DEFAULT_BUCKETS):
+        self.n = n
+        self.buckets = buckets
+        # number of corpus messages containing an n-gram of every bucket
+        self.frequencies = np.zeros(buckets, dtype=np.int32)
+        self.size = 0
+        self.add(messages)
+
+    def add(self, messages: list[str]) -> None:
+        # counts are updated in place, a prediction reading them meanwhile is off by a message at most
+        for message in messages:
+            np.add.at(self.frequencies, ngrams(message, self.n, self.buckets), 1)
+        self.size += len(messages)
+
+    def remove(self, messages: list[str]) -> None:
+        for message in messages:
+            np.subtract.at(self.frequencies, ngrams(message, self.n, self.buckets), 1)
+        self.size -= len(messages)
+
+    def score(self, message: str) -> float:
+        # idf-weighted share of the message's n-grams that occur in the corpus
+        grams = ngrams(message, self.n, self.buckets)
+        if len(grams) == 0 or self.size == 0:
+            return 1.0
+
+        frequencies = self.frequencies[grams]
+        weights = np.log((self.size + 1) / (frequencies + 1)) + 1
+        return float(weights[frequencies > 0].sum() / weights.sum())
+
+    def plausible(self, message: str, floor: Optional[float]) -> bool:
+        return floor is None or self.score(message) >= floor
+
+
+def evaluate(scores: list[float], answered: list[bool], floors: tuple = FLOORS) -> list[dict]:
+    # share of messages skipped and of answers of the full model lost for every floor
+    scores = np.asarray(scores, dtype=np.float32)
+    answered = np.asarray(answered, dtype=bool)
+    answers = int(answered.sum())
+
+    report = []
+    for floor in floors:
+        skipped = scores < floor
+        missed = int((skipped & answered).sum())
+        report.append({
+            "floor": floor,
+            "skip_rate": float(skipped.mean()) if len(scores) > 0 else None,
+            "missed_answers": missed,
+            "recall": 1 - missed / answers if answers > 0 else None
+        })
+
+    return report
+
+
+def recommend(report: list[dict], min_recall: float) -> Optional[float]:
+    # the highest floor which keeps at least min_recall of the answers
+    floors = [r["floor"] for r in report if r["recall"] is None or r["recall"] >= min_recall]
+    return max(floors) if len(floors) > 0 else None
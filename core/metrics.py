@@ -0,0 +1,234 @@
+import bisect
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+import core.log as log
+
+# seconds, from a cached clean up to the encoding of a long message on a busy cpu
+DEFAULT_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+                   5, 10)
+# refits and saves take much longer
+SLOW_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    labels = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if len(labels) > 0 else ""
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        # observations come from the event loop and from inference, refit and storage threads
+        self.lock = threading.Lock()
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"] + self.samples()
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        super(Counter, self).__init__(name, description, labels)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            values = list(self.values.items())
+        return [f"{self.name}{format_labels(self.labels, labels)} {format_value(v)}" for labels, v in values]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        super(Gauge, self).__init__(name, description, labels)
+        self.values: dict[tuple, float] = {}
+
+    def set(self, value: float, *labels) -> None:
+        with self.lock:
+            self.values[labels] = value
+
+    def remove(self, *labels) -> None:
+        with self.lock:
+            self.values.pop(labels, None)
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            values = list(self.values.items())
+        return [f"{self.name}{format_labels(self.labels, labels)} {format_value(v)}" for labels, v in values]
+
+
+class Timer:
+    def __init__(self, histogram: "Histogram", labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # labels -> (count per bucket, sum)
+        self.values: dict[tuple, (list[int], float)] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            counts, total = self.values.get(labels) or ([0] * len(self.buckets), 0.0)
+            counts[i] += 1
+            self.values[labels] = counts, total + value
+
+    def time(self, *labels) -> Timer:
+        return Timer(self, labels)
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self.values.items()]
+
+        lines = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = 'le="' + format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+CLEAN = registry.register(Histogram("autofaq_clean_seconds", "Time to clean an incoming message."))
+FILTER = registry.register(Histogram("autofaq_filter_seconds", "Time to check whether a message can be classified."))
+ENCODE = registry.register(Histogram("autofaq_encode_seconds", "Time to encode a single message or a batch."))
+SIMILARITY = registry.register(Histogram("autofaq_similarity_seconds",
+                                         "Time to score encoded messages against the corpus of a topic."))
+CHECK_MESSAGE = registry.register(Histogram("autofaq_check_message_seconds",
+                                            "End-to-end time to check an incoming message.", ("topic",)))
+REFIT = registry.register(Histogram("autofaq_refit_seconds", "Time to rebuild the classifier of a topic.",
+                                    ("topic",), SLOW_BUCKETS))
+SAVE = registry.register(Histogram("autofaq_save_seconds", "Time to write a document to the storage.",
+                                   buckets=SLOW_BUCKETS))
+STORAGE_SAVES = registry.register(Counter("autofaq_storage_saves_total",
+                                          "Saves of a document, coalesced by the write-behind."))
+STORAGE_WRITES = registry.register(Counter("autofaq_storage_writes_total", "Documents written to the storage."))
+STORAGE_BYTES = registry.register(Counter("autofaq_storage_written_bytes_total", "Bytes written to the storage."))
+STORAGE_ERRORS = registry.register(Counter("autofaq_storage_errors_total",
+                                           "Failed writes, which are retried with the next flush."))
+
+PREDICTIONS = registry.register(Counter("autofaq_predictions_total", "Classified incoming messages.", ("topic",)))
+ANSWERS = registry.register(Counter("autofaq_answers_total", "Automatic answers sent.", ("topic",)))
+NONSENSE = registry.register(Counter("autofaq_nonsense_total", "Messages classified as nonsense.", ("topic",)))
+VOTES = registry.register(Counter("autofaq_votes_total", "Votes on automatic answers.", ("topic", "vote")))
+PREDICTION_CACHE = registry.register(Counter("autofaq_prediction_cache_total",
+                                             "Lookups in the prediction cache by result: hit, miss or shared with an "
+                                             "identical prediction in flight.", ("topic", "result")))
+EXACT_MATCHES = registry.register(Counter("autofaq_exact_matches_total",
+                                          "Messages identical to a labeled message, answered without encoding.",
+                                          ("topic",)))
+LEXICAL_SKIPPED = registry.register(Counter("autofaq_lexical_skipped_total",
+                                            "Messages not encoded because no message of the corpus is similar.",
+                                            ("topic",)))
+RATE_LIMITED = registry.register(Counter("autofaq_rate_limited_total", "Messages skipped by the rate limiter.",
+                                         ("topic", "scope")))
+
+CORPUS_SIZE = registry.register(Gauge("autofaq_corpus_size", "Messages in the corpus of a topic.", ("topic",)))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+
+        body = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes would flood the log
+        pass
+
+
+server: Optional[ThreadingHTTPServer] = None
+
+
+def start(port: Optional[int], host: str = "127.0.0.1") -> Optional[ThreadingHTTPServer]:
+    global server
+
+    if not port or server is not None:
+        return server
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+
+    log.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+def shutdown() -> None:
+    global server
+
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+        server = None
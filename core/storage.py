@@ -0,0 +1,660 @@
+import asyncio
+import concurrent.futures
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+from urllib.parse import quote, unquote
+
+import core.log as log
+from core import metrics
+
+# the former single-file layout of all topics, fill words and nonsense
+DATA_DOCUMENT = "data"
+# fill words and nonsense are shared by all topics, while every topic has its own shard
+SHARED_DOCUMENT = "data/shared"
+TOPIC_PREFIX = "data/topics/"
+
+
+def topic_document(topic: str) -> str:
+    return TOPIC_PREFIX + quote(topic, safe="")
+
+
+def document_topic(name: str) -> Optional[str]:
+    return unquote(name[len(TOPIC_PREFIX):]) if name.startswith(TOPIC_PREFIX) else None
+
+
+def is_data_document(name: str) -> bool:
+    return name == DATA_DOCUMENT or name == SHARED_DOCUMENT or name.startswith(TOPIC_PREFIX)
+
+
+def split(content: dict) -> dict[str, dict]:
+    # splits the single-file layout into its shards
+    documents = {
+        SHARED_DOCUMENT: {
+            "fill_words": content.get("fill_words", []),
+            "nonsense": content.get("nonsense", [])
+        }
+    }
+
+    # an empty data.json stores its topics as a list
+    for topic, entries in (content.get("faq") or {}).items():
+        documents[topic_document(topic)] = {"faq": entries}
+
+    return documents
+
+
+class Storage:
+    def load(self, name: str) -> dict:
+        raise NotImplementedError()
+
+    def exists(self, name: str) -> bool:
+        raise NotImplementedError()
+
+    def topics(self) -> list[str]:
+        # every topic with a shard
+        raise NotImplementedError()
+
+    def snapshot(self, name: str, content: dict) -> Any:
+        # state of the last persisted content, which lets a storage engine write only what has changed since
+        return None
+
+    def prepare(self, name: str, content: dict, snapshot: Any = None) -> (Any, Any):
+        # turns the content into a payload for write() and returns it with the new snapshot; prepare runs where the
+        # content is modified, so write() can run on another thread
+        raise NotImplementedError()
+
+    def write(self, name: str, payload: Any) -> int:
+        # returns the number of bytes written
+        raise NotImplementedError()
+
+    def save(self, name: str, content: dict, snapshot: Any = None) -> Any:
+        payload, snapshot = self.prepare(name, content, snapshot)
+        with metrics.SAVE.time():
+            self.write(name, payload)
+        return snapshot
+
+    def flush(self) -> None:
+        pass
+
+    def shutdown(self) -> None:
+        self.flush()
+
+
+class JsonStorage(Storage):
+    def __init__(self, directory: str = "."):
+        self.directory = directory
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, f"{name}.json")
+
+    def load(self, name: str) -> dict:
+        path = self.path(name)
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                return json.load(f)
+        else:
+            return {}
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(self.path(name))
+
+    def topics(self) -> list[str]:
+        directory = os.path.join(self.directory, TOPIC_PREFIX)
+        if not os.path.isdir(directory):
+            return []
+        return [unquote(fn[:-5]) for fn in sorted(os.listdir(directory)) if fn.endswith(".json")]
+
+    def prepare(self, name: str, content: dict, snapshot: Any = None) -> (Any, Any):
+        return json.dumps(content, indent=2), None
+
+    def write(self, name: str, payload: Any) -> int:
+        path = self.path(name)
+        tmp_path = f"{path}.tmp"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # a crash while writing leaves the old file intact
+        with open(tmp_path, 'w') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+        return len(payload)
+
+
+class MemoryStorage(Storage):
+    # keeps documents in memory only, e.g. to work on a copy of a dataset
+    def __init__(self, documents: Optional[dict[str, dict]] = None):
+        self.documents = documents if documents is not None else {}
+
+    def load(self, name: str) -> dict:
+        return copy.deepcopy(self.documents.get(name, {}))
+
+    def exists(self, name: str) -> bool:
+        return name in self.documents
+
+    def topics(self) -> list[str]:
+        return [document_topic(name) for name in self.documents.keys() if name.startswith(TOPIC_PREFIX)]
+
+    def prepare(self, name: str, content: dict, snapshot: Any = None) -> (Any, Any):
+        return copy.deepcopy(content), None
+
+    def write(self, name: str, payload: Any) -> int:
+        self.documents[name] = payload
+        return 0
+
+
+def entry_row(entry: dict) -> tuple:
+    return entry["short"], entry["answer"], entry["up_votes"], entry["down_votes"], tuple(entry["messages"])
+
+
+class DataSnapshot:
+    def __init__(self, name: str, content: dict):
+        topic = document_topic(name)
+
+        if topic is not None:
+            faq = {topic: content.get("faq", [])}
+        elif name == DATA_DOCUMENT:
+            # an empty data.json stores its topics as a list
+            faq = content.get("faq") or {}
+        else:
+            faq = {}
+
+        # parts which are not part of the document are None and stay untouched
+        self.topics: dict[str, list[tuple]] = {topic: [entry_row(e) for e in entries] for topic, entries in faq.items()}
+        self.fill_words = tuple(content["fill_words"]) if "fill_words" in content else None
+        self.nonsense = tuple(content["nonsense"]) if "nonsense" in content else None
+
+
+class SqliteStorage(Storage):
+    def __init__(self, path: str = "data.db"):
+        self.path = path
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS documents (name TEXT PRIMARY KEY, content TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS faq_entries (
+                topic TEXT NOT NULL, position INTEGER NOT NULL, short TEXT NOT NULL, answer TEXT NOT NULL,
+                up_votes INTEGER NOT NULL DEFAULT 0, down_votes INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (topic, position)
+            );
+            CREATE INDEX IF NOT EXISTS faq_entries_short ON faq_entries (topic, short);
+            CREATE TABLE IF NOT EXISTS faq_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT NOT NULL, position INTEGER NOT NULL,
+                message TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS faq_messages_entry ON faq_messages (topic, position);
+            CREATE TABLE IF NOT EXISTS nonsense (id INTEGER PRIMARY KEY AUTOINCREMENT, message TEXT NOT NULL UNIQUE);
+            CREATE TABLE IF NOT EXISTS fill_words (position INTEGER PRIMARY KEY, word TEXT NOT NULL);
+        """)
+
+    def is_empty(self) -> bool:
+        with self.lock:
+            for table in ["documents", "faq_entries", "nonsense", "fill_words"]:
+                if self.connection.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone():
+                    return False
+        return True
+
+    def load(self, name: str) -> dict:
+        if name == DATA_DOCUMENT:
+            return {"faq": self.__load_faq__(), **self.__load_shared__()}
+        if name == SHARED_DOCUMENT:
+            return self.__load_shared__()
+
+        topic = document_topic(name)
+        if topic is not None:
+            return {"faq": self.__load_faq__(topic).get(topic, [])}
+
+        with self.lock:
+            row = self.connection.execute("SELECT content FROM documents WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def exists(self, name: str) -> bool:
+        topic = document_topic(name)
+
+        with self.lock:
+            if topic is not None:
+                return self.connection.execute("SELECT 1 FROM faq_entries WHERE topic = ? LIMIT 1",
+                                               (topic,)).fetchone() is not None
+            if is_data_document(name):
+                return any(self.connection.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone()
+                           for table in ["faq_entries", "nonsense", "fill_words"])
+            return self.connection.execute("SELECT 1 FROM documents WHERE name = ?", (name,)).fetchone() is not None
+
+    def topics(self) -> list[str]:
+        with self.lock:
+            return [t for t, in self.connection.execute("SELECT DISTINCT topic FROM faq_entries ORDER BY topic")]
+
+    def __load_shared__(self) -> dict:
+        with self.lock:
+            nonsense = self.connection.execute("SELECT message FROM nonsense ORDER BY id").fetchall()
+            fill_words = self.connection.execute("SELECT word FROM fill_words ORDER BY position").fetchall()
+
+        return {
+            "fill_words": [w for w, in fill_words],
+            "nonsense": [m for m, in nonsense]
+        }
+
+    def __load_faq__(self, topic: Optional[str] = None) -> dict[str, list[dict]]:
+        faq: dict[str, list[dict]] = {}
+        condition = "WHERE topic = ?" if topic is not None else ""
+        parameters = (topic,) if topic is not None else ()
+
+        with self.lock:
+            entries = self.connection.execute(
+                f"SELECT topic, short, answer, up_votes, down_votes FROM faq_entries {condition} "
+                f"ORDER BY topic, position", parameters
+            ).fetchall()
+            messages = self.connection.execute(
+                f"SELECT topic, position, message FROM faq_messages {condition} ORDER BY id", parameters
+            ).fetchall()
+
+        for topic, short, answer, up_votes, down_votes in entries:
+            faq.setdefault(topic, []).append({
+                "messages": [],
+                "answer": answer,
+                "up_votes": up_votes,
+                "down_votes": down_votes,
+                "short": short
+            })
+
+        for topic, position, message in messages:
+            faq[topic][position]["messages"].append(message)
+
+        return faq
+
+    def snapshot(self, name: str, content: dict) -> Any:
+        return DataSnapshot(name, content) if is_data_document(name) else None
+
+    def prepare(self, name: str, content: dict, snapshot: Any = None) -> (Any, Any):
+        # the payload is a list of (statement, rows) which write() executes in a single transaction
+        if not is_data_document(name):
+            return [("INSERT OR REPLACE INTO documents (name, content) VALUES (?, ?)",
+                     [(name, json.dumps(content))])], None
+
+        new = DataSnapshot(name, content)
+        old = snapshot if snapshot is not None else DataSnapshot(name, {})
+        statements = []
+
+        for topic in set(old.topics.keys()) | set(new.topics.keys()):
+            self.__prepare_topic__(statements, topic, old.topics.get(topic, []), new.topics.get(topic, []))
+
+        if new.fill_words is not None and old.fill_words != new.fill_words:
+            statements.append(("DELETE FROM fill_words", [()]))
+            statements.append(("INSERT INTO fill_words (position, word) VALUES (?, ?)",
+                               list(enumerate(new.fill_words))))
+
+        if new.nonsense is not None and old.nonsense != new.nonsense:
+            existing = set(old.nonsense) if old.nonsense is not None else set()
+            removed = existing - set(new.nonsense)
+            statements.append(("DELETE FROM nonsense WHERE message = ?", [(m,) for m in removed]))
+            statements.append(("INSERT OR IGNORE INTO nonsense (message) VALUES (?)",
+                               [(m,) for m in new.nonsense if m not in existing]))
+
+        return statements, new
+
+    def write(self, name: str, payload: Any) -> int:
+        written = 0
+
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute("BEGIN")
+            try:
+                for statement, rows in payload:
+                    if len(rows) > 0:
+                        cursor.executemany(statement, rows)
+                        written += sum(len(str(value)) for row in rows for value in row)
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+
+        return written
+
+    def __prepare_topic__(self, statements: list, topic: str, old: list[tuple], new: list[tuple]) -> None:
+        if old == new:
+            return
+
+        # a single deleted entry only shifts the positions of the following entries
+        if len(new) == len(old) - 1:
+            idx = next((i for i in range(len(new)) if new[i] != old[i]), len(new))
+            if new[idx:] == old[idx + 1:]:
+                statements.append(("DELETE FROM faq_entries WHERE topic = ? AND position = ?", [(topic, idx)]))
+                statements.append(("DELETE FROM faq_messages WHERE topic = ? AND position = ?", [(topic, idx)]))
+                # shifting in two steps avoids temporary primary key collisions
+                for table in ["faq_entries", "faq_messages"]:
+                    statements.append((f"UPDATE {table} SET position = -position - 1 WHERE topic = ? AND position > ?",
+                                       [(topic, idx)]))
+                    statements.append((f"UPDATE {table} SET position = -position - 2 WHERE topic = ? AND position < 0",
+                                       [(topic,)]))
+                return
+
+        if len(new) < len(old):
+            statements.append(("DELETE FROM faq_entries WHERE topic = ?", [(topic,)]))
+            statements.append(("DELETE FROM faq_messages WHERE topic = ?", [(topic,)]))
+            old = []
+
+        for position in range(len(new)):
+            if position >= len(old):
+                self.__insert_entry__(statements, topic, position, new[position])
+            elif new[position] != old[position]:
+                self.__update_entry__(statements, topic, position, old[position], new[position])
+
+    @staticmethod
+    def __insert_entry__(statements: list, topic: str, position: int, entry: tuple) -> None:
+        short, answer, up_votes, down_votes, messages = entry
+        statements.append(("INSERT OR REPLACE INTO faq_entries (topic, position, short, answer, up_votes, down_votes) "
+                           "VALUES (?, ?, ?, ?, ?, ?)", [(topic, position, short, answer, up_votes, down_votes)]))
+        statements.append(("INSERT INTO faq_messages (topic, position, message) VALUES (?, ?, ?)",
+                           [(topic, position, m) for m in messages]))
+
+    @staticmethod
+    def __update_entry__(statements: list, topic: str, position: int, old: tuple, new: tuple) -> None:
+        if old[:4] != new[:4]:
+            statements.append(("UPDATE faq_entries SET short = ?, answer = ?, up_votes = ?, down_votes = ? "
+                               "WHERE topic = ? AND position = ?", [(*new[:4], topic, position)]))
+
+        if old[4] != new[4]:
+            # messages are loaded in the order of their rows, so anything but appended messages rewrites the entry's
+            # messages to keep their order and duplicates
+            if new[4][:len(old[4])] == old[4]:
+                appended = new[4][len(old[4]):]
+            else:
+                statements.append(("DELETE FROM faq_messages WHERE topic = ? AND position = ?", [(topic, position)]))
+                appended = new[4]
+
+            statements.append(("INSERT INTO faq_messages (topic, position, message) VALUES (?, ?, ?)",
+                               [(topic, position, m) for m in appended]))
+
+
+def copy_documents(source: Storage, target: Storage, names: tuple = ("chat_data",)) -> None:
+    if source.exists(DATA_DOCUMENT) and not source.exists(SHARED_DOCUMENT):
+        documents = split(source.load(DATA_DOCUMENT))
+    else:
+        documents = {SHARED_DOCUMENT: source.load(SHARED_DOCUMENT)}
+        for topic in source.topics():
+            documents[topic_document(topic)] = source.load(topic_document(topic))
+
+    for name in names:
+        if source.exists(name):
+            documents[name] = source.load(name)
+
+    for name, content in documents.items():
+        target.save(name, content, target.snapshot(name, target.load(name)))
+
+
+def migrate(storage: Storage) -> bool:
+    # splits a single data.json into the shared document and one shard per topic
+    if storage.exists(SHARED_DOCUMENT) or not storage.exists(DATA_DOCUMENT):
+        return False
+
+    for name, content in split(storage.load(DATA_DOCUMENT)).items():
+        storage.save(name, content, storage.snapshot(name, {}))
+
+    log.info("The dataset has been split into one file per topic.")
+    return True
+
+
+class PendingSnapshot:
+    # handed to a File instead of the real snapshot, which only exists once the write-behind has prepared its save
+    def __init__(self, value: Any):
+        # the state the next save is prepared against, which includes the writes still queued
+        self.value = value
+        # the state which has actually been written
+        self.written = value
+        # bumped by a failed write, the queued writes prepared against the lost state are skipped
+        self.epoch = 0
+
+
+class WriteStatistics:
+    def __init__(self):
+        self.saves = 0
+        self.flushes = 0
+        self.bytes_written = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def saved(self) -> None:
+        self.saves += 1
+        metrics.STORAGE_SAVES.inc()
+
+    def add(self, written: int, latency: float) -> None:
+        self.flushes += 1
+        self.bytes_written += written
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        metrics.STORAGE_WRITES.inc()
+        metrics.STORAGE_BYTES.inc(amount=written)
+        metrics.SAVE.observe(latency)
+
+    def as_dict(self) -> dict:
+        return {
+            "saves": self.saves,
+            "flushes": self.flushes,
+            "bytes_written": self.bytes_written,
+            "mean_flush_ms": self.total_latency * 1000 / self.flushes if self.flushes > 0 else 0,
+            "max_flush_ms": self.max_latency * 1000
+        }
+
+
+def everything(name: str) -> bool:
+    return True
+
+
+class WriteBehind(Storage):
+    # saves only mark a document dirty; all saves within the interval are coalesced into one write which happens on
+    # a background thread
+    def __init__(self, storage: Storage, interval: float = 2.0):
+        self.storage = storage
+        self.interval = interval
+        self.pending: dict[tuple, (str, dict, PendingSnapshot)] = {}
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.statistics = WriteStatistics()
+        # documents whose write failed, they are prepared again against the last written state
+        self.failed: dict[tuple, (str, dict, PendingSnapshot)] = {}
+        # guards the snapshots and the failed documents, which the writer thread changes on failure
+        self.lock = threading.Lock()
+
+        # a single writer keeps the writes in order
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+        # (document name, write) of every write which might not be done yet
+        self.writes: list[(str, Future)] = []
+
+    def load(self, name: str) -> dict:
+        # read your own writes, only the writes of this document are waited for
+        self.sync(lambda n: n == name)
+        return self.storage.load(name)
+
+    def exists(self, name: str) -> bool:
+        self.sync(lambda n: n == name)
+        return self.storage.exists(name)
+
+    def topics(self) -> list[str]:
+        self.sync(lambda name: name.startswith(TOPIC_PREFIX))
+        return self.storage.topics()
+
+    def snapshot(self, name: str, content: dict) -> Any:
+        return PendingSnapshot(self.storage.snapshot(name, content))
+
+    def save(self, name: str, content: dict, snapshot: Any = None) -> Any:
+        if not isinstance(snapshot, PendingSnapshot):
+            snapshot = PendingSnapshot(snapshot)
+
+        self.statistics.saved()
+        self.pending[(name, id(content))] = (name, content, snapshot)
+
+        try:
+            self.loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no event loop (e.g. during startup), so there is nothing to block
+            self.flush()
+            return snapshot
+
+        self.__schedule__()
+        return snapshot
+
+    def __schedule__(self) -> None:
+        if self.flush_handle is None:
+            self.flush_handle = self.loop.call_later(self.interval, self.__flush_pending__)
+
+    def __flush_pending__(self, selected: Optional[Callable[[str], bool]] = None) -> list[Future]:
+        # prepares the pending saves of the selected documents, or of all documents, and returns the writes of those
+        # documents which are not done yet
+        if selected is None:
+            selected = everything
+            if self.flush_handle is not None:
+                self.flush_handle.cancel()
+                self.flush_handle = None
+
+        with self.lock:
+            for key, document in list(self.failed.items()):
+                if selected(document[0]):
+                    # a newer save of the document is prepared against the same written state
+                    self.pending.setdefault(key, document)
+                    self.failed.pop(key)
+
+            for key, (name, content, snapshot) in list(self.pending.items()):
+                if not selected(name):
+                    continue
+
+                # preparing reads the content, so it happens on the thread that modifies it
+                self.pending.pop(key)
+                payload, value = self.storage.prepare(name, content, snapshot.value)
+                snapshot.value = value
+                self.writes.append((name, self.executor.submit(self.__write__, name, content, snapshot, payload,
+                                                               value, snapshot.epoch)))
+
+        self.writes = [(name, w) for name, w in self.writes if not w.done()]
+        return [w for name, w in self.writes if selected(name)]
+
+    def __write__(self, name: str, content: dict, snapshot: PendingSnapshot, payload: Any, value: Any,
+                  epoch: int) -> None:
+        if epoch != snapshot.epoch:
+            # an earlier write of the document failed, its retry includes this one
+            return
+
+        t = time.perf_counter()
+        try:
+            written = self.storage.write(name, payload)
+        except Exception as e:
+            log.error(f"Could not save '{name}', retrying:", e)
+            metrics.STORAGE_ERRORS.inc()
+
+            with self.lock:
+                snapshot.epoch += 1
+                snapshot.value = snapshot.written
+                self.failed[(name, id(content))] = (name, content, snapshot)
+
+            if self.loop is not None and not self.loop.is_closed():
+                self.loop.call_soon_threadsafe(self.__schedule__)
+            return
+
+        snapshot.written = value
+        self.statistics.add(written, time.perf_counter() - t)
+
+    def sync(self, selected: Optional[Callable[[str], bool]] = None) -> None:
+        # waits until the saves of the selected documents, or of all documents, are written. Failed writes get one
+        # more attempt, e.g. when shutting down.
+        for _ in range(2):
+            for write in self.__prepare__(selected):
+                write.result()
+
+            with self.lock:
+                if not any((selected or everything)(name) for name, _, _ in self.failed.values()):
+                    return
+
+    def __prepare__(self, selected: Optional[Callable[[str], bool]] = None) -> list[Future]:
+        # the content is modified on the event loop, so other threads have the loop prepare the saves
+        try:
+            on_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            on_loop = False
+
+        if on_loop or self.loop is None or not self.loop.is_running():
+            return self.__flush_pending__(selected)
+
+        prepared = Future()
+
+        def prepare() -> None:
+            try:
+                prepared.set_result(self.__flush_pending__(selected))
+            except BaseException as e:
+                prepared.set_exception(e)
+
+        self.loop.call_soon_threadsafe(prepare)
+        while True:
+            try:
+                return prepared.result(timeout=1)
+            except concurrent.futures.TimeoutError:
+                if not self.loop.is_running():
+                    # the loop stopped before it got to the preparation, nothing modifies the content any more
+                    return self.__flush_pending__(selected)
+
+    def flush(self) -> None:
+        self.sync()
+
+    def shutdown(self) -> None:
+        self.flush()
+        self.executor.shutdown()
+        log.info("Storage statistics:", self.statistics.as_dict())
+
+
+def create(engine: str, path: Optional[str] = None, interval: float = 0) -> Storage:
+    storage = __create__(engine, path)
+
+    if interval > 0:
+        return WriteBehind(storage, interval)
+    return storage
+
+
+def __create__(engine: str, path: Optional[str] = None) -> Storage:
+    if engine == "sqlite":
+        path = path if path else "data.db"
+        exists = os.path.exists(path)
+        storage = SqliteStorage(path)
+
+        # the first start with SQLite takes over the existing JSON files
+        if not exists and storage.is_empty():
+            copy_documents(JsonStorage(os.path.dirname(path) or "."), storage)
+
+        return storage
+    if engine == "json":
+        storage = JsonStorage(path if path else ".")
+        migrate(storage)
+        return storage
+
+    raise ValueError(f"Unknown storage engine '{engine}'")
+
+
+storage: Storage = JsonStorage()
+
+
+def setup(s: Storage) -> Storage:
+    global storage
+    storage = s
+    return s
+
+
+if __name__ == "__main__":
+    # python -m core.storage import|export <json directory> <sqlite file>
+    import sys
+
+    json_storage = JsonStorage(sys.argv[2])
+    sqlite_storage = SqliteStorage(sys.argv[3])
+
+    if sys.argv[1] == "import":
+        copy_documents(json_storage, sqlite_storage)
+    elif sys.argv[1] == "export":
+        copy_documents(sqlite_storage, json_storage)
+    else:
+        print("Usage: python -m core.storage import|export <json directory> <sqlite file>")
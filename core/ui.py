@@ -141,7 +141,7 @@ class FaqDeleteUndoView(View):
 
     @nextcord.ui.button(label="Restore", style=nextcord.ButtonStyle.gray)
     async def undo(self, button: nextcord.Button, interaction: nextcord.Interaction) -> None:
-        if self.faq.data.append_faq_entry(self.entry):
+        if await self.faq.restore_entry(self.entry):
             log.info(f"The FAQ entry '{self.entry.short()}' has been restored",
                      f"by {interaction.user.name}#{interaction.user.discriminator}.")
 
@@ -155,7 +155,6 @@ class FaqDeleteUndoView(View):
                 color=COLOR_WARNING
             )
             await interaction.edit(embed=embed, view=None)
-            self.faq.refit()
         else:
             embed = Embed(
                 title="FAQ Entry Deletion",
@@ -0,0 +1,292 @@
+import hashlib
+import threading
+import uuid
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Callable, Optional
+
+import numpy as np
+
+import core.log as log
+from core import filter, metrics
+from core.classifier import GENERATIONS, BertClassifier, ModelRegistry
+from core.files import Data, SharedData
+from core.index import IndexSettings
+from core.inference import InferenceEngine
+
+DEFAULT_ADDRESS = "autofaq.sock"
+
+
+def authkey(token: str) -> bytes:
+    # the bot and the worker read the same config, so the token authenticates the bot without another secret
+    return hashlib.sha256(f"autofaq-worker:{token}".encode("utf-8")).digest()
+
+
+class WorkerError(Exception):
+    pass
+
+
+# The worker owns the encoder and the corpus of every topic. Bot processes send their requests over a Unix socket,
+# so several of them share a single model. The worker only reads the storage, all writes happen in the bots. Every bot
+# process has its own Data, so it also gets its own copy of every topic: changes of one process must not shift the
+# entry ids another one maps its answers with. The copies of an unchanged corpus map the same shared embeddings.
+class WorkerServer:
+    def __init__(self, address: str, key: bytes, models: ModelRegistry, index_settings: IndexSettings):
+        self.address = address
+        self.key = key
+        self.models = models
+        self.index_settings = index_settings
+        # (client, topic) -> classifier
+        self.classifiers: dict[tuple[str, str], BertClassifier] = {}
+        # open connections of every client, its topics are dropped with the last one
+        self.connections: dict[str, int] = {}
+        # builds and changes of a corpus are serialized, so concurrent appends cannot overwrite each other
+        self.lock = threading.Lock()
+
+        self.methods: dict[str, Callable] = {
+            "ping": self.ping,
+            "encode": self.encode,
+            "load": self.load,
+            "refit": self.refit,
+            "classify": self.classify,
+            "append": self.append,
+            "remove": self.remove
+        }
+
+    def serve(self) -> None:
+        with Listener(self.address, family="AF_UNIX", authkey=self.key) as listener:
+            log.info(f"Inference worker listening on {self.address}")
+
+            while True:
+                try:
+                    connection = listener.accept()
+                except Exception as e:
+                    # e.g. a client with the wrong key
+                    log.warning("Rejected a connection to the inference worker:", e)
+                    continue
+
+                threading.Thread(target=self.__handle__, args=(connection,), name="worker-connection",
+                                 daemon=True).start()
+
+    def __handle__(self, connection: Connection) -> None:
+        client: Optional[str] = None
+
+        with connection:
+            while True:
+                try:
+                    sender, method, args = connection.recv()
+                except (EOFError, OSError):
+                    break
+
+                if client is None:
+                    client = sender
+                    with self.lock:
+                        self.connections[client] = self.connections.get(client, 0) + 1
+
+                try:
+                    result = ("ok", self.methods[method](client, *args))
+                except Exception as e:
+                    result = ("error", f"{type(e).__name__}: {e}")
+
+                try:
+                    connection.send(result)
+                except (EOFError, OSError):
+                    break
+
+        if client is not None:
+            self.__disconnected__(client)
+
+    def __disconnected__(self, client: str) -> None:
+        with self.lock:
+            self.connections[client] -= 1
+            if self.connections[client] > 0:
+                return
+
+            self.connections.pop(client)
+            for key in [key for key in self.classifiers if key[0] == client]:
+                self.classifiers.pop(key)
+
+        log.info(f"Dropped the topics of client {client}.")
+
+    def __build__(self, client: str, topic: str) -> BertClassifier:
+        # every build reads the current state of the storage, including the fill words and nonsense
+        classifier = BertClassifier(Data(topic, SharedData()), models=self.models, index_settings=self.index_settings)
+        self.classifiers[(client, topic)] = classifier
+        log.info(f"Topic '{topic}' has been built with {len(classifier.entry_ids)} messages for client {client}.")
+        return classifier
+
+    def __classifier__(self, client: str, topic: str) -> BertClassifier:
+        classifier = self.classifiers.get((client, topic))
+
+        if classifier is None:
+            with self.lock:
+                classifier = self.classifiers.get((client, topic))
+                if classifier is None:
+                    classifier = self.__build__(client, topic)
+
+        return classifier
+
+    def ping(self, client: str) -> bool:
+        return True
+
+    def encode(self, client: str, messages: list[str]) -> np.ndarray:
+        with metrics.ENCODE.time():
+            return self.models.get().encode(messages)
+
+    def load(self, client: str, topic: str) -> int:
+        return len(self.__classifier__(client, topic).entry_ids)
+
+    def refit(self, client: str, topic: str) -> int:
+        with self.lock:
+            return len(self.__build__(client, topic).entry_ids)
+
+    def classify(self, client: str, topic: str, message: str) -> (Optional[int], Optional[float]):
+        # the message is already cleaned and filtered by the bot
+        classifier = self.__classifier__(client, topic)
+
+        if not classifier.plausible(message):
+            return None, None
+
+        with metrics.ENCODE.time():
+            embed = classifier.encode([message])[0]
+
+        with metrics.SIMILARITY.time():
+            return classifier.classify(embed)
+
+    def append(self, client: str, topic: str, entry_id: int, messages: list[str]) -> int:
+        classifier = self.__classifier__(client, topic)
+        with self.lock:
+            classifier.append(entry_id, messages)
+        return len(classifier.entry_ids)
+
+    def remove(self, client: str, topic: str, entry_id: int) -> int:
+        classifier = self.__classifier__(client, topic)
+        with self.lock:
+            classifier.remove(entry_id)
+        return len(classifier.entry_ids)
+
+
+class WorkerClient:
+    def __init__(self, address: str, key: bytes):
+        self.address = address
+        self.key = key
+        # identifies this process to the worker, which keeps a copy of every topic per client
+        self.client = uuid.uuid4().hex
+        # connections are not thread-safe, so every inference thread gets its own
+        self.local = threading.local()
+
+    def __connection__(self) -> Connection:
+        connection = getattr(self.local, "connection", None)
+
+        if connection is None:
+            connection = Client(self.address, family="AF_UNIX", authkey=self.key)
+            self.local.connection = connection
+
+        return connection
+
+    def call(self, method: str, *args):
+        connection = self.__connection__()
+
+        try:
+            connection.send((self.client, method, args))
+            status, result = connection.recv()
+        except (EOFError, OSError):
+            # the worker restarted, the next call reconnects
+            self.local.connection = None
+            connection.close()
+            raise
+
+        if status == "error":
+            raise WorkerError(result)
+        return result
+
+    def available(self) -> bool:
+        try:
+            return self.call("ping")
+        except (OSError, EOFError, AuthenticationError, WorkerError):
+            return False
+
+
+class RemoteClassifier:
+    # stands in for a BertClassifier whose corpus lives in the inference worker
+    def __init__(self, client: WorkerClient, data: Data, inference: Optional[InferenceEngine] = None,
+                 refit: bool = False):
+        self.client = client
+        self.data = data
+        self.topic = data.topic
+        self.inference = inference
+        self.generation = next(GENERATIONS)
+        self.corpus_size: int = client.call("refit" if refit else "load", self.topic)
+
+    def size(self) -> int:
+        return self.corpus_size
+
+    def append(self, entry_id: int, messages: list[str]) -> None:
+        if len(messages) == 0:
+            return
+
+        self.corpus_size = self.client.call("append", self.topic, entry_id, messages)
+        self.generation = next(GENERATIONS)
+
+    def remove(self, entry_id: int) -> None:
+        self.corpus_size = self.client.call("remove", self.topic, entry_id)
+        self.generation = next(GENERATIONS)
+
+    async def predict_async(self, message: str) -> (Optional[int], int):
+        # the worker does the heavy lifting, so requests skip the local micro-batching
+        if self.inference is None:
+            return self.predict(message)
+        return await self.inference.run(self.predict, message)
+
+    def prepare(self, message: str) -> Optional[str]:
+        with metrics.CLEAN.time():
+            message = self.data.clean_message(message)
+
+        with metrics.FILTER.time():
+            valid = filter.is_valid(message)
+
+        if not valid or self.corpus_size == 0:
+            return None
+
+        return message
+
+    def predict(self, message: str) -> (Optional[int], int):
+        message = self.prepare(message)
+
+        if message is None:
+            return None, None
+
+        return self.client.call("classify", self.topic, message)
+
+
+if __name__ == "__main__":
+    # python -m core.worker [socket]: serves the encoder and the topic indexes to the bot processes
+    import os
+    import sys
+
+    import core.storage
+    from core.files import Config
+
+    log.load_logging_handlers()
+
+    config = Config()
+    core.storage.setup(core.storage.create(config.storage_engine(), config.storage_path()))
+    metrics.start(config.worker_metrics_port())
+
+    if config.torch_threads():
+        import torch
+        torch.set_num_threads(config.torch_threads())
+
+    models = ModelRegistry(config.embedding_cache(), config.encoder_backend())
+    models.get()
+
+    address = sys.argv[1] if len(sys.argv) > 1 else config.inference_worker() or DEFAULT_ADDRESS
+    if os.path.exists(address):
+        # left over from a previous run
+        os.remove(address)
+
+    # the copies of a topic for the bot processes map the same embeddings file
+    shared_indexes = config.shared_indexes() or os.path.join(config.embedding_cache() or "embeddings", "worker")
+    settings = IndexSettings(config.ann_min_corpus(), config.ann_probes(), config.embedding_precision(),
+                             shared_indexes, config.lexical_floor())
+    WorkerServer(address, authkey(config.token()), models, settings).serve()
@@ -0,0 +1,229 @@
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+
+from core.storage import JsonStorage, SHARED_DOCUMENT, SqliteStorage, WriteBehind, topic_document
+
+TOPIC = "python"
+DOCUMENT = topic_document(TOPIC)
+
+
+def entry(short: str, messages: list[str], up_votes: int = 0, down_votes: int = 0) -> dict:
+    return {
+        "messages": messages,
+        "answer": f"The answer to {short}.",
+        "up_votes": up_votes,
+        "down_votes": down_votes,
+        "short": short
+    }
+
+
+def topic(*entries: dict) -> dict:
+    return {"faq": list(entries)}
+
+
+class StorageTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.sqlite = SqliteStorage(os.path.join(self.directory.name, "data.db"))
+        self.json = JsonStorage(self.directory.name)
+
+    def tearDown(self):
+        self.sqlite.connection.close()
+        self.directory.cleanup()
+
+    def save(self, content: dict, snapshot=None, name: str = DOCUMENT):
+        # saves the content into both engines, the SQLite engine only writes what changed since the snapshot
+        self.json.save(name, content)
+        return self.sqlite.save(name, content, snapshot)
+
+    def assert_stored(self, content: dict, name: str = DOCUMENT):
+        self.assertEqual(content, self.sqlite.load(name))
+        self.assertEqual(self.json.load(name), self.sqlite.load(name))
+
+
+class SqliteStorageTest(StorageTest):
+    def setUp(self):
+        super().setUp()
+        self.content = topic(
+            entry("install", ["how do i install it", "where is the installer"], 3, 1),
+            entry("update", ["how do i update"]),
+            entry("logs", ["where are the logs", "log file location"]),
+            entry("crash", ["it crashes on start"], 0, 2)
+        )
+        self.snapshot = self.save(self.content)
+
+    def test_save_and_load(self):
+        self.assert_stored(self.content)
+
+    def test_delete_entry(self):
+        for position in [1, 0, 1]:
+            self.content["faq"].pop(position)
+            self.snapshot = self.save(self.content, self.snapshot)
+            self.assert_stored(self.content)
+
+    def test_delete_last_entry(self):
+        self.content["faq"].pop()
+        self.save(self.content, self.snapshot)
+        self.assert_stored(self.content)
+
+    def test_delete_all_entries(self):
+        self.content["faq"].clear()
+        self.save(self.content, self.snapshot)
+        self.assertEqual([], self.sqlite.topics())
+        self.assertEqual({"faq": []}, self.sqlite.load(DOCUMENT))
+
+    def test_delete_several_entries(self):
+        del self.content["faq"][1:3]
+        self.save(self.content, self.snapshot)
+        self.assert_stored(self.content)
+
+    def test_coalesced_changes(self):
+        # a deletion, a restore, a vote and new messages, all written at once
+        faq = self.content["faq"]
+        removed = faq.pop(1)
+        faq[0]["up_votes"] += 1
+        faq[1]["messages"].append("logs folder")
+        faq[2]["messages"].remove("it crashes on start")
+        faq.append(removed)
+        removed["messages"].append("newest version")
+
+        self.snapshot = self.save(self.content, self.snapshot)
+        self.assert_stored(self.content)
+
+        # the new snapshot is the base of the next change
+        faq[3]["down_votes"] += 1
+        faq[1]["short"] = "log"
+        self.save(self.content, self.snapshot)
+        self.assert_stored(self.content)
+
+    def test_delete_and_add_entry(self):
+        self.content["faq"].pop(0)
+        self.content["faq"].append(entry("license", ["which license is it"]))
+        self.save(self.content, self.snapshot)
+        self.assert_stored(self.content)
+
+    def test_duplicate_messages(self):
+        self.content["faq"][1]["messages"].append("how do i update")
+        self.save(self.content, self.snapshot)
+        self.assert_stored(self.content)
+
+    def test_rewritten_messages(self):
+        # e.g. repaired by Data.repair_messages, the order of the messages is kept
+        self.content["faq"][2]["messages"][0] = "where r the logs"
+        self.content["faq"][0]["messages"].remove("how do i install it")
+        self.save(self.content, self.snapshot)
+        self.assert_stored(self.content)
+
+    def test_topics_are_independent(self):
+        other = topic(entry("install", ["how do i install java"]))
+        self.save(other, self.sqlite.snapshot(topic_document("java"), {}), topic_document("java"))
+
+        self.content["faq"].pop(0)
+        self.save(self.content, self.snapshot)
+        self.assert_stored(self.content)
+        self.assert_stored(other, topic_document("java"))
+
+    def test_shared_document(self):
+        shared = {"fill_words": ["hi", "hello"], "nonsense": ["lol", "ok"]}
+        snapshot = self.save(shared, self.sqlite.snapshot(SHARED_DOCUMENT, {}), SHARED_DOCUMENT)
+
+        shared["fill_words"].remove("hi")
+        shared["nonsense"].remove("lol")
+        shared["nonsense"].append("thanks")
+        self.save(shared, snapshot, SHARED_DOCUMENT)
+        self.assert_stored(shared, SHARED_DOCUMENT)
+
+
+class FlakyStorage(SqliteStorage):
+    # fails the first write, which blocks until the test releases it
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.failures = 1
+        self.release = threading.Event()
+        self.release.set()
+
+    def write(self, name, payload) -> int:
+        self.release.wait()
+        if self.failures > 0:
+            self.failures -= 1
+            raise OSError("database is locked")
+        return super().write(name, payload)
+
+
+class WriteBehindTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.flaky = FlakyStorage(os.path.join(self.directory.name, "data.db"))
+        self.storage = WriteBehind(self.flaky, interval=60)
+        self.content = topic(entry("install", ["how do i install it"]), entry("update", ["how do i update"]))
+
+    def tearDown(self):
+        self.storage.shutdown()
+        self.flaky.connection.close()
+        self.directory.cleanup()
+
+    def test_retry_without_event_loop(self):
+        self.storage.save(DOCUMENT, self.content, self.storage.snapshot(DOCUMENT, {}))
+        self.assertEqual(self.content, self.storage.load(DOCUMENT))
+
+    def test_writes_queued_behind_a_failed_one(self):
+        async def run():
+            snapshot = self.storage.snapshot(DOCUMENT, {})
+
+            # the first write fails after the next one has been prepared against it
+            self.flaky.release.clear()
+            snapshot = self.storage.save(DOCUMENT, self.content, snapshot)
+            self.storage.__flush_pending__()
+
+            self.content["faq"][0]["messages"].append("where is the installer")
+            self.content["faq"][1]["up_votes"] += 1
+            self.storage.save(DOCUMENT, self.content, snapshot)
+            self.storage.__flush_pending__()
+
+            self.flaky.release.set()
+            self.storage.flush()
+
+        asyncio.run(run())
+        self.assertEqual(self.content, self.flaky.load(DOCUMENT))
+
+    def test_save_after_failed_write(self):
+        async def run():
+            snapshot = self.storage.snapshot(DOCUMENT, {})
+            snapshot = self.storage.save(DOCUMENT, self.content, snapshot)
+            self.storage.__flush_pending__()
+            for write in self.storage.writes:
+                write.result()
+
+            # the document is saved again before the retry is flushed
+            self.content["faq"].pop(0)
+            self.storage.save(DOCUMENT, self.content, snapshot)
+            self.storage.flush()
+
+        asyncio.run(run())
+        self.assertEqual(self.content, self.flaky.load(DOCUMENT))
+        self.assertEqual(0, len(self.storage.failed))
+
+    def test_load_waits_for_its_document_only(self):
+        other = topic_document("java")
+
+        async def run():
+            # the write of another document is stuck
+            self.flaky.failures = 0
+            self.flaky.release.clear()
+            self.storage.save(other, topic(), self.storage.snapshot(other, {}))
+            self.storage.__flush_pending__()
+
+            self.storage.save(DOCUMENT, self.content, self.storage.snapshot(DOCUMENT, {}))
+            loaded = await asyncio.wait_for(asyncio.to_thread(self.storage.load, DOCUMENT), 5)
+            self.flaky.release.set()
+            return loaded
+
+        self.assertEqual(self.content, asyncio.run(run()))
+        self.assertEqual(1, len(self.storage.pending) + len(self.storage.writes))
+
+
+if __name__ == "__main__":
+    unittest.main()